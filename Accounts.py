@@ -1,9 +1,15 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, inspect, event, select, func
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm.attributes import flag_modified
 
 from Transactions import Base, Transaction
+from Snapshots import BalanceSnapshot
+from money import Money, Rate, to_money
 import logging
-from decimal import Decimal
+from decimal import Decimal, localcontext
+from datetime import timedelta
+from collections import Counter
+from bisect import bisect_left, bisect_right
 
 class OverdrawError(Exception):
     pass
@@ -16,6 +22,11 @@ class TransactionSequenceError(Exception):
         super().__init__()
         self.latest_date = date
 
+class ConcurrentUpdateError(Exception):
+    """Another session or process changed the account first. Nothing was saved;
+    retrying with freshly loaded data may succeed."""
+    pass
+
 
 class Account(Base):
     """This is an abstract class for accounts.  Provides default functionality for adding transactions, getting balances, and assessing interest and fees.  
@@ -23,20 +34,41 @@ class Account(Base):
 
     __tablename__ = "account"
     _id = Column(Integer, primary_key = True)
-    _bank_id = Column(Integer, ForeignKey("bank._id"))
-    _transactions = relationship("Transaction", backref = backref("account"))
+    _bank_id = Column(Integer, ForeignKey("bank._id"), index = True)
+    # kept in date order (ties in insertion order) so the latest transaction is always last
+    _transactions = relationship("Transaction", backref = backref("account"),
+                                 order_by = [Transaction._date, Transaction._id])
+    # query-style view of the same rows for paging through very large accounts
+    # without loading the whole history into the session
+    _transaction_query = relationship("Transaction", lazy = "dynamic", viewonly = True,
+                                      order_by = [Transaction._date, Transaction._id])
     _type = Column(String)
-    _account_number = Column(Integer)
+    _account_number = Column(Integer, unique = True, index = True)
+    # running total of _transactions, kept in step by add_transaction
+    _balance = Column(Money)
+    # bumped by every write to the account row; an UPDATE that finds a different
+    # version means another session wrote first and fails with StaleDataError
+    _version = Column(Integer, nullable = False, server_default = "0")
     
     __mapper_args__ = {
         'polymorphic_identity':'account',
-        'polymorphic_on': _type
+        'polymorphic_on': _type,
+        'version_id_col': _version
     }
 
+    # dates and running balances parallel to _transactions, used for
+    # balance-at-date lookups; rebuilt from the transactions on first use
+    _ledger_dates = None
+    _ledger_sums = None
+    # (latest BalanceSnapshot or None, transactions saved after it in date order):
+    # everything new transactions are checked against, loaded on first use
+    _window = None
+
     def __init__(self, acct_num):
         
         self._account_number = acct_num
-        logging.debug(f"Created account: {self._account_number}")
+        self._balance = Decimal(0)
+        logging.debug("Created account: %s", self._account_number)
 
     def add_transaction(self, amt, session, date=None, exempt=False):
         """Creates a new transaction and checks to see if it is allowed, adding it to the account if it is.
@@ -52,13 +84,121 @@ class Account(Base):
                         date=date,
                         exempt=exempt)
 
+        self._validate_transaction(t)
+        # added first so any query made while recording it (and its autoflush) sees it
+        session.add(t)
+        self._insert_transaction(t)
+        self._record_transaction(t)
+        #logging.debug(f"Created transaction: {self._account_number}, {amt}")
+
+    def _validate_transaction(self, t):
+        """Checks a pending transaction against the balance, limit and date rules unless it is exempt
+
+        Raises:
+            InvalidAmountError: the new balance would be too large to store, even for an exempt transaction
+            OverdrawError, TransactionLimitError, TransactionSequenceError
+        """
+        # the balance column holds 64-bit cents like the amount, so check it before the flush would fail
+        to_money(self.get_balance() + t.amt)
         if not t.is_exempt():
             self._check_balance(t)
             self._check_limits(t)
             self._check_date(t)
-        self._transactions.append(t)
-        #logging.debug(f"Created transaction: {self._account_number}, {amt}")
-        session.add(t)
+
+    def _insert_transaction(self, t):
+        """Adds a transaction to the account's list, keeping the list in date order.
+
+        Args:
+            t (Transaction): transaction to add
+        """
+        if "_transactions" in inspect(self).unloaded:
+            # the backref queues the new transaction without loading the whole history
+            t.account = self
+            return
+        transactions = self._transactions
+        if transactions and t < transactions[-1]:
+            # only exempt transactions can be back-dated
+            transactions.insert(bisect_right(transactions, t), t)
+        else:
+            transactions.append(t)
+
+    def _record_transaction(self, t):
+        """Updates the cached state of the account for a transaction that was just added.
+
+        Args:
+            t (Transaction): transaction that was added to the account
+        """
+        self._balance = self.get_balance() + t.amt
+        # a zero amount leaves the balance unchanged, but the row must still be written
+        # so the version check catches a concurrent transaction against the same limits
+        flag_modified(self, "_balance")
+        _, recent = self._recent()
+        i = bisect_right(recent, t)
+        # a window built from an in-memory account's list already holds it, among its date's transactions
+        if not any(x is t for x in recent[bisect_left(recent, t):i]):
+            recent.insert(i, t)
+        if self._ledger_dates is not None:
+            if not self._ledger_dates or t.date >= self._ledger_dates[-1]:
+                self._ledger_dates.append(t.date)
+                self._ledger_sums.append(self._balance)
+            else:
+                # a back-dated transaction shifts every later running balance
+                self._ledger_dates = None
+                self._ledger_sums = None
+
+    def _ledger(self):
+        """Returns the dates and running balances of the transactions, building them if needed"""
+        if self._ledger_dates is None or self._ledger_sums is None:
+            dates = []
+            sums = []
+            total = Decimal(0)
+            for t in self._transactions:
+                total += t.amt
+                dates.append(t.date)
+                sums.append(total)
+            self._ledger_dates = dates
+            self._ledger_sums = sums
+        return self._ledger_dates, self._ledger_sums
+
+    def _recent(self):
+        """Returns the latest snapshot (or None) and the transactions after it, loading them if needed"""
+        if self._window is None:
+            session = object_session(self)
+            if self._id is None or session is None:
+                self._window = (None, list(self._transactions))
+            else:
+                load_recent(session, [self])
+        return self._window
+
+    def _close_month(self, month_end, session):
+        """Saves a snapshot of the account after interest and fees were assessed for a month.
+
+        Args:
+            month_end (Date): last day of the month that was assessed
+        """
+        # the snapshot records the ids of the transactions it covers
+        if object_session(self) is not session:
+            session.add(self)
+        session.flush()
+        snapshot, recent = self._recent()
+        last_id = max((t._id for t in recent), default=snapshot._last_transaction_id if snapshot else 0)
+        day_count = month_count = 0
+        # recent is in date order, so the month's transactions are at the end
+        for t in reversed(recent):
+            if (t.date.year, t.date.month) != (month_end.year, month_end.month):
+                break
+            if not t.is_exempt():
+                month_count += 1
+                day_count += t.date == month_end
+        new = BalanceSnapshot(self._id, month_end, self.get_balance(), last_id, day_count, month_count)
+        session.add(new)
+        self._window = (new, [])
+
+    def _reset_caches(self):
+        """Discards the in-memory indexes derived from the transactions so they are rebuilt on next use"""
+        self._ledger_dates = None
+        self._ledger_sums = None
+        self._window = None
 
     def _check_balance(self, t):
         """Checks whether an incoming transaction would overdraw the account
@@ -76,22 +216,83 @@ class Account(Base):
         pass
 
     def _check_date(self, t):
-        if len(self._transactions) > 0:
-            latest_transaction = max(self._transactions)
-            if t < latest_transaction:
-                raise TransactionSequenceError(latest_transaction.date)
+        latest_date = self.get_latest_date()
+        if latest_date is not None and t.date < latest_date:
+            raise TransactionSequenceError(latest_date)
 
-    def get_balance(self):
-        """Gets the balance for an account by summing its transactions
+    def get_latest_date(self):
+        """Gets the date of the most recent transaction
+
+        Returns:
+            Date: latest transaction date, or None if the account has no transactions
+        """
+        snapshot, recent = self._recent()
+        if recent:
+            return max(recent[-1].date, snapshot.date) if snapshot else recent[-1].date
+        return snapshot.date if snapshot else None
+
+    def get_balance(self, as_of=None):
+        """Gets the balance for an account from its cached running total
+
+        Args:
+            as_of (Date, optional): return the balance at the end of this day instead of the current balance. Defaults to None.
 
         Returns:
             Decimal: current balance
         """
-        # could have a balance variable updated when transactions are added (or removed) which is faster
-        # but this is more foolproof since it's always in sync with transactions
-        # this could be improved by caching the sum to avoid too much
-        # recalculation, while still maintaining the list as the ground truth
-        return sum(x for x in self._transactions)
+        if as_of is not None:
+            dates, sums = self._ledger()
+            i = bisect_right(dates, as_of)
+            return sums[i - 1] if i else Decimal(0)
+        # the transactions stay the ground truth; a missing cache is rebuilt from
+        # the latest snapshot and the transactions after it
+        if self._balance is None:
+            snapshot, recent = self._recent()
+            self._balance = (snapshot._balance if snapshot else Decimal(0)) + sum(x for x in recent)
+        return self._balance
+
+    def average_daily_balance(self, start, end):
+        """Gets the average of the end-of-day balances over a period, e.g. a month, for
+        average-daily-balance interest
+
+        Args:
+            start (Date): first day of the period
+            end (Date): last day of the period
+
+        Returns:
+            Decimal: average balance, rounded to cents (half up)
+        """
+        days = (end - start).days + 1
+        # enough digits that the sum is exact and only the rounding to cents affects the average
+        with localcontext() as ctx:
+            ctx.prec = 40
+            total = sum(self.get_balance(as_of=start + timedelta(i)) for i in range(days))
+            return to_money(total / days)
+
+    def verify_balance(self):
+        """Recomputes the balance from the transactions and compares it with the cached balance
+
+        Returns:
+            Decimal: drift between the transactions and the cache (0 if they agree)
+        """
+        actual = sum(x for x in self._transactions)
+        if self._balance is None:
+            return actual
+        return actual - self._balance
+
+    def rebuild_balance(self):
+        """Replaces the cached balance with the sum of the transactions
+
+        Returns:
+            Decimal: drift that was corrected (0 if the cache was already correct)
+        """
+        actual = sum(x for x in self._transactions)
+        drift = actual if self._balance is None else actual - self._balance
+        if drift and self._balance is not None:
+            logging.warning("Balance drift of %s on account %s", drift, self._account_number)
+        self._balance = actual
+        self._reset_caches()
+        return drift
 
     def _assess_interest(self, latest_transaction, session):
         """Calculates interest for an account balance and adds it as a new transaction exempt from limits.
@@ -110,14 +311,23 @@ class Account(Base):
             TransactionSequenceError: Indicates that the new transactions were
             not newer than the most recent interest or fees transactions
         """
-        latest_transaction = max(self._transactions)
-        for t in self._transactions:
-            if t.is_exempt() and t.in_same_month(latest_transaction):
+        snapshot, recent = self._recent()
+        if snapshot is not None and (not recent or (recent[-1].date.year, recent[-1].date.month)
+                                     <= (snapshot.date.year, snapshot.date.month)):
+            # the latest month (back-dated transactions aside) was closed by an earlier assessment
+            raise TransactionSequenceError(snapshot.date)
+        latest_transaction = recent[-1]
+        # transactions are in date order, so only the tail can share the latest month
+        for t in reversed(recent):
+            if not t.in_same_month(latest_transaction):
+                break
+            if t.is_exempt():
                 # found an interest or fee transaction that is already in the
                 # same month as the most recent transaction
                 raise TransactionSequenceError(t.date)
         self._assess_interest(latest_transaction, session)
         self._assess_fees(latest_transaction, session)
+        self._close_month(latest_transaction.last_day_of_month(), session)
 
     def __str__(self):
         """Formats the account number and balance of the account.
@@ -125,8 +335,45 @@ class Account(Base):
         """
         return f"#{self._account_number:09},\tbalance: ${self.get_balance():,.2f}"
 
-    def get_transactions(self):
-        return self._transactions
+    def get_transactions(self, offset=0, limit=None, start_date=None, end_date=None):
+        """Gets a page of the account's transactions in date order.
+
+        Saved accounts are paged with OFFSET/LIMIT in the database, so only the
+        requested rows are loaded rather than the whole history.
+
+        Args:
+            offset (int, optional): number of matching transactions to skip. Defaults to 0.
+            limit (int, optional): maximum number of transactions to return. Defaults to None (no limit).
+            start_date (Date, optional): earliest date to include. Defaults to None.
+            end_date (Date, optional): latest date to include. Defaults to None.
+
+        Returns:
+            list: matching transactions
+        """
+        if not inspect(self).persistent:
+            transactions = [t for t in self._transactions
+                            if (start_date is None or t.date >= start_date)
+                            and (end_date is None or t.date <= end_date)]
+            return transactions[offset:None if limit is None else offset + limit]
+        return self._query_transactions(start_date, end_date).offset(offset).limit(limit).all()
+
+    def count_transactions(self, start_date=None, end_date=None):
+        """Counts the account's transactions, optionally within a date range, without loading them
+
+        Returns:
+            int: number of matching transactions
+        """
+        if not inspect(self).persistent:
+            return len(self.get_transactions(start_date=start_date, end_date=end_date))
+        return self._query_transactions(start_date, end_date).count()
+
+    def _query_transactions(self, start_date, end_date):
+        query = self._transaction_query
+        if start_date is not None:
+            query = query.filter(Transaction._date >= start_date)
+        if end_date is not None:
+            query = query.filter(Transaction._date <= end_date)
+        return query
 
 
 class SavingsAccount(Account):
@@ -136,18 +383,53 @@ class SavingsAccount(Account):
     _id = Column(Integer, ForeignKey("account._id"), primary_key=True)
     _daily_limit = Column(Integer)
     _monthly_limit = Column(Integer)
-    _interest_rate = Column(Float(asdecimal=True))
+    _interest_rate = Column(Rate)
 
     __mapper_args__ = {
         "polymorphic_identity": "savings"
     }
 
+    # counts of non-exempt transactions by date and by (year, month); not
+    # persisted, so accounts loaded from the database rebuild them on first use
+    _daily_counts = None
+    _monthly_counts = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._interest_rate = Decimal("0.029")
         self._daily_limit = 2
         self._monthly_limit = 5
         self._type = "savings"
+        self._daily_counts = Counter()
+        self._monthly_counts = Counter()
+
+    def _limit_counters(self):
+        """Returns the daily and monthly counters, building them from the latest snapshot and the transactions after it if needed"""
+        if self._daily_counts is None or self._monthly_counts is None:
+            snapshot, recent = self._recent()
+            self._daily_counts = Counter()
+            self._monthly_counts = Counter()
+            if snapshot is not None:
+                self._daily_counts[snapshot.date] = snapshot._day_count
+                self._monthly_counts[(snapshot.date.year, snapshot.date.month)] = snapshot._month_count
+            for t in recent:
+                self._count_transaction(t)
+        return self._daily_counts, self._monthly_counts
+
+    def _reset_caches(self):
+        super()._reset_caches()
+        self._daily_counts = None
+        self._monthly_counts = None
+
+    def _count_transaction(self, t):
+        if not t.is_exempt():
+            self._daily_counts[t.date] += 1
+            self._monthly_counts[(t.date.year, t.date.month)] += 1
+
+    def _record_transaction(self, t):
+        super()._record_transaction(t)
+        if self._daily_counts is not None and self._monthly_counts is not None:
+            self._count_transaction(t)
 
     def _check_limits(self, t1):
         """determines if the incoming trasaction is within the accounts transaction limits
@@ -158,12 +440,11 @@ class SavingsAccount(Account):
         Returns:
             bool: true if within limits and false if beyond limits
         """
+        daily_counts, monthly_counts = self._limit_counters()
         # Count number of non-exempt transactions on the same day as t1
-        num_today = len(
-            [t2 for t2 in self._transactions if not t2.is_exempt() and t2.in_same_day(t1)])
+        num_today = daily_counts[t1.date]
         # Count number of non-exempt transactions in the same month as t1
-        num_this_month = len(
-            [t2 for t2 in self._transactions if not t2.is_exempt() and t2.in_same_month(t1)])
+        num_this_month = monthly_counts[(t1.date.year, t1.date.month)]
         # check counts against daily and monthly limits
         if (num_today >= self._daily_limit or num_this_month >= self._monthly_limit):
             raise TransactionLimitError()
@@ -180,9 +461,9 @@ class CheckingAccount(Account):
     """
     __tablename__ = "checking_account"
     _id = Column(Integer, ForeignKey("account._id"), primary_key=True)
-    _balance_threshold = Column(Float)
-    _low_balance_fee = Column(Float)
-    _interest_rate = Column(Float(asdecimal=True))
+    _balance_threshold = Column(Money)
+    _low_balance_fee = Column(Money)
+    _interest_rate = Column(Rate)
 
     __mapper_args__ = {
         "polymorphic_identity": "checking"
@@ -191,8 +472,8 @@ class CheckingAccount(Account):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._interest_rate = Decimal("0.0012")
-        self._balance_threshold = 100
-        self._low_balance_fee = -10
+        self._balance_threshold = Decimal(100)
+        self._low_balance_fee = Decimal(-10)
         self._type = "checking"
 
     def _assess_fees(self, latest_transaction, session):
@@ -208,3 +489,53 @@ class CheckingAccount(Account):
         For example, 'Checking#000000001,<tab>balance: $50.00'
         """
         return "Checking" + super().__str__()
+
+
+def expire_accounts(session):
+    """Expires every account in a session and discards their in-memory indexes, so they are
+    re-read from the database after another session, thread or process has written to it.
+
+    Args:
+        session (Session): session whose accounts should be re-read
+    """
+    session.expire_all()
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Account):
+            obj._reset_caches()
+
+
+def load_recent(session, accounts, batch_size=500):
+    """Loads the latest snapshot and the transactions after it for many accounts at once,
+    with two queries per batch, so validating transactions for them needs no more queries.
+
+    Args:
+        accounts (iterable): saved accounts
+        batch_size (int, optional): accounts per query, to stay under SQLite's parameter limit. Defaults to 500.
+    """
+    accounts = [a for a in accounts if a._id is not None]
+    for i in range(0, len(accounts), batch_size):
+        batch = {a._id: a for a in accounts[i:i + batch_size]}
+        latest = (select(func.max(BalanceSnapshot._id))
+                  .where(BalanceSnapshot._account_id.in_(list(batch)))
+                  .group_by(BalanceSnapshot._account_id))
+        snapshots = {s._account_id: s for s in session.scalars(select(BalanceSnapshot)
+                                                                .where(BalanceSnapshot._id.in_(latest)))}
+        covered = (select(func.max(BalanceSnapshot._last_transaction_id))
+                   .where(BalanceSnapshot._account_id == Transaction._account_id)
+                   .scalar_subquery())
+        recent = {account_id: [] for account_id in batch}
+        for t in session.scalars(select(Transaction)
+                                 .where(Transaction._account_id.in_(list(batch)),
+                                        Transaction._id > func.coalesce(covered, 0))
+                                 .order_by(Transaction._account_id, Transaction._date, Transaction._id)):
+            recent[t._account_id].append(t)
+        for account_id, a in batch.items():
+            a._window = (snapshots.get(account_id), recent[account_id])
+
+
+@event.listens_for(Account, "expire", propagate=True)
+def _reset_caches_on_expire(target, attrs):
+    # expired columns are re-read on next use, possibly with another process's writes,
+    # so indexes built from the old values must be rebuilt too (after commit and rollback as well)
+    if target is not None:
+        target._reset_caches()
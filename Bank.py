@@ -1,13 +1,50 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, create_engine
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, create_engine, func, select, update, insert, case, and_, bindparam, event
+from sqlalchemy.orm import relationship, backref, object_session, selectinload, noload
 import logging
-from Transactions import Base
-from Accounts import SavingsAccount, CheckingAccount
+import csv
+import json
+from collections import namedtuple, Counter
+from itertools import groupby
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from Transactions import Base, Transaction
+from money import InvalidAmountError, to_money
+from Accounts import Account, SavingsAccount, CheckingAccount, OverdrawError, TransactionLimitError, TransactionSequenceError, ConcurrentUpdateError, load_recent
+from Snapshots import BalanceSnapshot
 
 
 SAVINGS = "savings"
 CHECKING = "checking"
 
+# how Bank.load_accounts fetches each account's transactions
+LAZY = "select"         # one SELECT per account, when its transactions are first used
+SELECTIN = "selectin"   # one extra SELECT ... IN for the whole batch of accounts
+NOLOAD = "noload"       # never; for work that only needs the account rows
+RECENT = "recent"       # only the latest balance snapshot and the transactions after it, for checking new ones
+
+# SQLite limits the number of bound parameters in one statement
+_IN_BATCH_SIZE = 500
+
+# a row of an import file that could not be applied, with the exception explaining why
+Rejection = namedtuple("Rejection", ["row", "account_number", "error"])
+
+
+class AccountSummary(namedtuple("AccountSummary", ["type", "account_number", "balance"])):
+    """One line of the bank summary, formatted the same way as the account itself"""
+    __slots__ = ()
+
+    def __str__(self):
+        return f"{self.type.capitalize()}#{self.account_number:09},\tbalance: ${self.balance:,.2f}"
+
+# what a month-end run did to one account: the amounts added, or the exception that prevented it
+MonthEndResult = namedtuple("MonthEndResult", ["account_number", "interest", "fee", "error"])
+
+
+class UnknownAccountError(LookupError):
+    def __init__(self, account_number):
+        super().__init__(f"No account #{account_number:09}")
+        self.account_number = account_number
+
 class Bank(Base):
     """ A class that maintains a set of bank accounts"""
 
@@ -15,6 +52,11 @@ class Bank(Base):
 
     _id = Column(Integer, primary_key=True)
     _accounts = relationship("Account", backref = "bank")
+    # last account number handed out; only ever advanced in SQL by _generate_account_number
+    _last_account_number = Column(Integer)
+
+    # account number -> Account for every account opened or looked up so far
+    _accounts_by_number = None
 
     #def __init__(self):
     #    self._accounts = []
@@ -25,26 +67,122 @@ class Bank(Base):
         Args:
             type (string): "Savings" or "Checking" to indicate the type of account to create
             amt (Decimal): amount for the new transaction representing the initial deposit
+
+        Returns:
+            Account: the new account, or None if the type is not recognized
         """
 
-        acct_num = self._generate_account_number()
         if acct_type == SAVINGS:
-            a = SavingsAccount(acct_num)
+            account_class = SavingsAccount
         elif acct_type == CHECKING:
-            a = CheckingAccount(acct_num)
+            account_class = CheckingAccount
         else:
             return None
-        self._accounts.append(a)
+        a = account_class(self._generate_account_number(session))
+        # the deposit is checked before the account is linked to the bank, so a rejected
+        # one leaves nothing behind for the next flush
         a.add_transaction(amt, session)
+        # setting the backref instead of appending to _accounts avoids loading every account
+        a.bank = self
+        self._account_index()[a._account_number] = a
         session.add(a)
+        return a
+
+    def _generate_account_number(self, session):
+        """Allocates the next account number like a database sequence.
+
+        The counter on the bank row is advanced with a single UPDATE, so the row stays
+        locked until the session commits and concurrent processes never receive the
+        same number. Numbers are not reused if the account is never saved.
+
+        Returns:
+            int: newly allocated account number
+        """
+        if self._id is None:
+            session.flush()
+        bank = Bank.__table__
+        account = Account.__table__
+        # databases created before the counter existed start from the highest number in use
+        highest = (select(func.coalesce(func.max(account.c._account_number), 0))
+                   .where(account.c._bank_id == bank.c._id)
+                   .scalar_subquery())
+        session.execute(update(bank)
+                        .where(bank.c._id == self._id)
+                        .values(_last_account_number=func.coalesce(bank.c._last_account_number, highest) + 1))
+        return session.execute(select(bank.c._last_account_number)
+                               .where(bank.c._id == self._id)).scalar_one()
 
-    def _generate_account_number(self):
-        return len(self._accounts) + 1
+    def _account_index(self):
+        if self._accounts_by_number is None:
+            self._accounts_by_number = {}
+        return self._accounts_by_number
 
     def show_accounts(self):
         "Accessor method to return accounts"
         return self._accounts
 
+    def load_accounts(self, session, account_numbers=None, transactions=SELECTIN):
+        """Loads many accounts at once, choosing how their transactions are loaded.
+
+        Use SELECTIN for bulk operations that touch the history of every account,
+        RECENT for adding transactions to many accounts, and LAZY or NOLOAD when only
+        some or none of the histories are needed; very large accounts can be paged
+        with Account.get_transactions instead.
+
+        Args:
+            account_numbers (iterable, optional): accounts to load. Defaults to None (every account).
+            transactions (str, optional): LAZY, SELECTIN, NOLOAD or RECENT. Defaults to SELECTIN.
+
+        Returns:
+            list: the matching accounts, which are also added to the account number index
+        """
+        query = session.query(Account).filter(Account._bank_id == self._id)
+        if transactions == SELECTIN:
+            query = query.options(selectinload(Account._transactions))
+        elif transactions == NOLOAD:
+            query = query.options(noload(Account._transactions))
+        if account_numbers is None:
+            accounts = query.order_by(Account._account_number).all()
+        else:
+            numbers = list(account_numbers)
+            accounts = []
+            for i in range(0, len(numbers), _IN_BATCH_SIZE):
+                accounts.extend(query.filter(Account._account_number.in_(numbers[i:i + _IN_BATCH_SIZE])))
+        if transactions == RECENT:
+            load_recent(session, accounts, _IN_BATCH_SIZE)
+        index = self._account_index()
+        for a in accounts:
+            index[a._account_number] = a
+        return accounts
+
+    def summary(self, session, account_numbers=None):
+        """Gets the type, number and balance of every account with one query, without
+        loading any Account or Transaction objects.
+
+        Balances come from the accounts' cached running totals, so the cost does not
+        grow with the number of transactions; only accounts saved without one have
+        their transactions summed.
+
+        Args:
+            account_numbers (iterable, optional): only summarize these accounts. Defaults to None (every account).
+
+        Returns:
+            list: an AccountSummary per account, in account number order
+        """
+        account = Account.__table__
+        transaction = Transaction.__table__
+        total = (select(func.sum(transaction.c._amt))
+                 .where(transaction.c._account_id == account.c._id)
+                 .scalar_subquery())
+        # SQLite only evaluates the subquery when the cached balance is NULL
+        query = (select(account.c._type, account.c._account_number,
+                        func.coalesce(account.c._balance, total, 0))
+                 .where(account.c._bank_id == self._id)
+                 .order_by(account.c._account_number))
+        if account_numbers is not None:
+            query = query.where(account.c._account_number.in_(list(account_numbers)))
+        return [AccountSummary(*row) for row in session.execute(query)]
+
     def get_account(self, account_num):
         """Fetches an account by its account number.
 
@@ -54,8 +192,313 @@ class Bank(Base):
         Returns:
             Account: matching account or None if not found
         """        
-        for x in self._accounts:
-            # could be faster using dictionary
-            if x._account_number == account_num:
-                return x
-        return None
+        index = self._account_index()
+        account = index.get(account_num)
+        if account is None:
+            session = object_session(self)
+            if session is None:
+                account = next((x for x in self._accounts if x._account_number == account_num), None)
+            else:
+                # uses the index on _account_number rather than loading every account
+                account = (session.query(Account)
+                           .filter(Account._bank_id == self._id,
+                                   Account._account_number == account_num)
+                           .one_or_none())
+            if account is not None:
+                index[account_num] = account
+        return account
+
+    def rebuild_balances(self):
+        """Recomputes every account's cached balance from its transactions.
+
+        Returns:
+            dict: account number -> drift for each account whose cache was out of sync
+        """
+        drifts = {}
+        session = object_session(self)
+        accounts = self._accounts if session is None else self.load_accounts(session)
+        for x in accounts:
+            drift = x.rebuild_balance()
+            if drift:
+                drifts[x._account_number] = drift
+        return drifts
+
+    def run_month_end(self, month, session):
+        """Assesses interest and fees for every account in the bank for one month.
+
+        Works like Account.assess_interest_and_fees, but balances and the "already assessed"
+        check come from one aggregate query over each account's latest balance snapshot
+        and the transactions after it, and the new transactions and snapshots are bulk
+        inserted, so no account's transactions are loaded. Accounts already assessed in
+        the month, or with transactions after it, are skipped with a TransactionSequenceError.
+        The caller commits.
+
+        Args:
+            month (Date): any day in the month to assess
+
+        Returns:
+            list: a MonthEndResult for every account, in account number order
+        """
+        first = date(month.year, month.month, 1)
+        # first of the next month (wrapping around to January) minus one day
+        last = date(month.year + month.month // 12, month.month % 12 + 1, 1) - timedelta(1)
+
+        account = Account.__table__
+        transaction = Transaction.__table__
+        snapshot = BalanceSnapshot.__table__
+        savings = SavingsAccount.__table__
+        checking = CheckingAccount.__table__
+        newer = snapshot.alias("newer")
+        latest_snapshot = (select(func.max(newer.c._id))
+                           .where(newer.c._account_id == account.c._id)
+                           .correlate(account)
+                           .scalar_subquery())
+        in_month = transaction.c._date.between(first, last)
+        counted = transaction.c._exempt.isnot(True)
+        query = (select(account.c._id, account.c._account_number, account.c._type, account.c._version,
+                        snapshot.c._balance.label("snapshot_balance"),
+                        snapshot.c._date.label("snapshot_date"),
+                        func.sum(transaction.c._amt).label("recent_sum"),
+                        func.max(transaction.c._date).label("recent_latest"),
+                        func.max(case((and_(transaction.c._exempt.is_(True), in_month), transaction.c._date))).label("assessed"),
+                        func.count(case((and_(counted, in_month), 1))).label("month_count"),
+                        func.count(case((and_(counted, transaction.c._date == last), 1))).label("day_count"),
+                        func.coalesce(savings.c._interest_rate, checking.c._interest_rate).label("rate"),
+                        checking.c._balance_threshold, checking.c._low_balance_fee)
+                 .select_from(account)
+                 .outerjoin(snapshot, snapshot.c._id == latest_snapshot)
+                 # only the transactions the snapshot does not cover
+                 .outerjoin(transaction, and_(transaction.c._account_id == account.c._id,
+                                              transaction.c._id > func.coalesce(snapshot.c._last_transaction_id, 0)))
+                 .outerjoin(savings, savings.c._id == account.c._id)
+                 .outerjoin(checking, checking.c._id == account.c._id)
+                 .where(account.c._bank_id == self._id)
+                 .group_by(account.c._id)
+                 .order_by(account.c._account_number))
+
+        results = []
+        new_rows = []
+        balances = []
+        snapshots = []
+        for row in session.execute(query):
+            latest = max(d for d in (row.recent_latest, row.snapshot_date, date.min) if d is not None)
+            assessed = row.assessed
+            if assessed is None and row.snapshot_date is not None and first <= row.snapshot_date <= last:
+                assessed = row.snapshot_date
+            if latest == date.min:
+                # an account without transactions has nothing to assess
+                continue
+            if assessed is not None:
+                results.append(MonthEndResult(row._account_number, None, None,
+                                              TransactionSequenceError(assessed)))
+                continue
+            if latest > last:
+                results.append(MonthEndResult(row._account_number, None, None,
+                                              TransactionSequenceError(latest)))
+                continue
+            balance = (row.snapshot_balance or Decimal(0)) + (row.recent_sum or Decimal(0))
+            # rounded to cents as Transaction does, so the cached balance matches the stored rows
+            interest = to_money(balance * row.rate)
+            balance += interest
+            new_rows.append({"_account_id": row._id, "_amt": interest, "_date": last, "_exempt": True})
+            fee = None
+            if row._type == CHECKING and balance < row._balance_threshold:
+                fee = row._low_balance_fee
+                balance += fee
+                new_rows.append({"_account_id": row._id, "_amt": fee, "_date": last, "_exempt": True})
+            balances.append({"b_id": row._id, "b_version": row._version, "b_balance": balance})
+            snapshots.append({"s_account_id": row._id, "_date": last, "_balance": balance,
+                              "_day_count": row.day_count, "_month_count": row.month_count})
+            results.append(MonthEndResult(row._account_number, interest, fee, None))
+
+        if new_rows:
+            session.execute(insert(Transaction), new_rows)
+            # the same version check the ORM makes, so a transaction committed by another
+            # process since the balances were read is not overwritten
+            updated = session.execute(update(account)
+                                      .where(account.c._id == bindparam("b_id"),
+                                             account.c._version == bindparam("b_version"))
+                                      .values(_balance=bindparam("b_balance"), _version=account.c._version + 1),
+                                      balances).rowcount
+            if updated != len(balances):
+                raise ConcurrentUpdateError(f"{len(balances) - updated} account(s) changed during month-end")
+            # each snapshot covers the account's transactions up to the interest and fee just inserted
+            session.execute(insert(snapshot)
+                            .values(_account_id=bindparam("s_account_id"),
+                                    _last_transaction_id=select(func.max(transaction.c._id))
+                                    .where(transaction.c._account_id == bindparam("s_account_id"))
+                                    .scalar_subquery()),
+                            snapshots)
+            # accounts already in the session no longer match the database
+            assessed = {b["b_id"] for b in balances}
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, Account) and obj._id in assessed:
+                    session.expire(obj, ["_balance", "_version", "_transactions"])
+                    obj._reset_caches()
+        logging.debug("Month-end for %s: assessed %d of %d accounts", f"{first:%Y-%m}", len(balances), len(results))
+        return results
+
+    def rebuild_snapshots(self, session):
+        """Replaces every account's balance snapshots with ones recomputed from the full history.
+
+        A snapshot is written after each month's interest and fee transactions, covering
+        every transaction saved up to them. Use it after upgrading a database that
+        predates snapshots, or if they are suspected to be wrong. The caller commits.
+
+        Returns:
+            int: number of snapshots written
+        """
+        account = Account.__table__
+        transaction = Transaction.__table__
+        snapshot = BalanceSnapshot.__table__
+        accounts = select(account.c._id).where(account.c._bank_id == self._id)
+        session.execute(snapshot.delete().where(snapshot.c._account_id.in_(accounts)))
+
+        rows = session.execute(select(transaction.c._id, transaction.c._account_id, transaction.c._amt,
+                                      transaction.c._date, transaction.c._exempt)
+                               .where(transaction.c._account_id.in_(accounts))
+                               .order_by(transaction.c._account_id, transaction.c._id))
+        snapshots = []
+        for account_id, history in groupby(rows, key=lambda r: r._account_id):
+            balance = Decimal(0)
+            latest = None
+            last_id = None
+            daily = Counter()
+            monthly = Counter()
+            closing = None
+            for r in history:
+                # a month is closed once its interest and fee rows (exempt, saved together) are all seen
+                if closing is not None and not (r._exempt and r._date == closing):
+                    snapshots.append(_snapshot_row(account_id, latest, balance, last_id, daily, monthly))
+                    closing = None
+                # interest and fees are dated the last day of the latest transaction's month
+                if r._exempt and (latest is None or r._date >= latest) and (r._date + timedelta(1)).day == 1:
+                    closing = r._date
+                balance += r._amt
+                latest = r._date if latest is None else max(latest, r._date)
+                last_id = r._id
+                if not r._exempt:
+                    daily[r._date] += 1
+                    monthly[(r._date.year, r._date.month)] += 1
+            if closing is not None:
+                snapshots.append(_snapshot_row(account_id, latest, balance, last_id, daily, monthly))
+        if snapshots:
+            session.execute(insert(BalanceSnapshot), snapshots)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Account):
+                obj._reset_caches()
+        logging.debug("Rebuilt %d balance snapshots", len(snapshots))
+        return len(snapshots)
+
+    def import_transactions(self, source, session, fmt=None):
+        """Imports transactions from a CSV or JSON Lines file in one database transaction.
+
+        Rows need "account", "amount" and "date" (YYYY-MM-DD) fields. Each account's rows
+        are checked in date order against the same rules as Account.add_transaction, and
+        the accepted rows are written with one bulk insert. Every row is an ordinary
+        transaction; only the month-end run adds exempt interest and fees.
+        The caller commits.
+
+        Args:
+            source (str or file): path of the file, or an open text file
+            fmt (str, optional): "csv" or "jsonl". Defaults to the file extension.
+
+        Returns:
+            list: a Rejection for every row that was not imported
+        """
+        rejected = []
+        batches = {}
+        for row_num, fields, error in _read_import_rows(source, fmt):
+            if error is not None:
+                rejected.append(Rejection(row_num, None, error))
+                continue
+            try:
+                account_number = int(fields["account"])
+            except (KeyError, TypeError, ValueError) as e:
+                rejected.append(Rejection(row_num, fields.get("account"), e))
+                continue
+            try:
+                # InvalidAmountError (a ValueError) for NaN, infinities and amounts too large to store
+                amount = to_money(str(fields["amount"]))
+                date = fields.get("date") or None
+                if date is not None:
+                    date = datetime.strptime(date, "%Y-%m-%d").date()
+            except (KeyError, ValueError) as e:
+                rejected.append(Rejection(row_num, account_number, e))
+                continue
+            batches.setdefault(account_number, []).append((row_num, amount, date))
+
+        rows = []
+        touched = []
+        # every batch is checked against its account's activity since the last month-end
+        self.load_accounts(session, batches.keys(), transactions=RECENT)
+        try:
+            for account_number, batch in batches.items():
+                account = self.get_account(account_number)
+                if account is None:
+                    rejected.extend(Rejection(row_num, account_number, UnknownAccountError(account_number))
+                                    for row_num, *_ in batch)
+                    continue
+                touched.append(account)
+                if account._id is None:
+                    session.flush()
+                # undated rows default to today, like Account.add_transaction
+                for row_num, amount, date in sorted(batch, key=lambda r: r[2] or datetime.now().date()):
+                    try:
+                        t = Transaction(amount, account_number, date=date)
+                        account._validate_transaction(t)
+                    except (InvalidAmountError, OverdrawError, TransactionLimitError, TransactionSequenceError) as e:
+                        rejected.append(Rejection(row_num, account_number, e))
+                        continue
+                    account._record_transaction(t)
+                    rows.append({"_account_id": account._id, "_amt": t.amt,
+                                 "_date": t.date, "_exempt": t.is_exempt()})
+            if rows:
+                session.execute(insert(Transaction), rows)
+        except Exception:
+            # the cached balances and indexes already include rows that were never written
+            for account in touched:
+                session.expire(account)
+                account._reset_caches()
+            raise
+        for account in touched:
+            # the new rows bypassed the relationship, so reload it on next use
+            session.expire(account, ["_transactions"])
+        logging.debug("Imported %d transactions, rejected %d", len(rows), len(rejected))
+        rejected.sort(key=lambda r: r.row)
+        return rejected
+
+
+def _snapshot_row(account_id, latest, balance, last_id, daily, monthly):
+    return {"_account_id": account_id, "_date": latest, "_balance": balance, "_last_transaction_id": last_id,
+            "_day_count": daily[latest], "_month_count": monthly[(latest.year, latest.month)]}
+
+
+@event.listens_for(Bank, "expire")
+def _reset_index_on_expire(target, attrs):
+    # after a rollback the index may hold accounts that were never saved
+    if target is not None:
+        target._accounts_by_number = None
+
+
+def _read_import_rows(source, fmt=None):
+    """Yields (row number, field dictionary, parse error or None) for each row of a CSV or JSON Lines import file"""
+    if isinstance(source, str):
+        if fmt is None:
+            fmt = "jsonl" if source.lower().endswith((".jsonl", ".json")) else "csv"
+        with open(source, newline="") as f:
+            yield from _read_import_rows(f, fmt)
+        return
+    if fmt == "jsonl":
+        for row_num, line in enumerate(source, start=1):
+            if line.strip():
+                try:
+                    fields = json.loads(line)
+                except ValueError as e:
+                    yield row_num, None, e
+                else:
+                    yield row_num, fields, None
+    else:
+        # row 1 is the header
+        for row_num, fields in enumerate(csv.DictReader(source), start=2):
+            yield row_num, fields, None
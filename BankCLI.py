@@ -1,16 +1,31 @@
+import argparse
+import json
+import os
 import sys
 import logging
-from decimal import Decimal, InvalidOperation
 from datetime import datetime
-import sqlalchemy
-from sqlalchemy.orm.session import sessionmaker
 
-from Transactions import Base
-from Bank import Bank
-from Accounts import OverdrawError, TransactionLimitError, TransactionSequenceError
+from Bank import Bank, UnknownAccountError
+from Accounts import OverdrawError, TransactionLimitError, TransactionSequenceError, ConcurrentUpdateError, expire_accounts
+from logconfig import configure_logging
+from migrations import SchemaVersionError, MigrationError
+from database import Session, init_db, commit_with_retry, make_engine
+from commits import make_coordinator
+from money import InvalidAmountError, to_money
+import metrics
 
-logging.basicConfig(filename='bank.log', level=logging.DEBUG,
-                    format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+TRANSACTION_PAGE_SIZE = 100
+CONFLICT_MESSAGE = "The account was changed by another user at the same time. Please try again."
+INVALID_AMOUNT_MESSAGE = "Please try again with a valid dollar amount."
+UNEXPECTED_MESSAGE = ("Sorry! Something unexpected happened. "
+                      "If this problem persists please contact our support team for assistance.")
+# commands run between commits in batch mode
+BATCH_COMMIT_EVERY = 1000
+
+
+class CommandError(ValueError):
+    """A batch command that could not be understood"""
+    pass
 
 
 class BankCLI():
@@ -29,6 +44,8 @@ class BankCLI():
             self._session.commit()
             logging.debug("Saved to bank.db")       
         self._selected_account = None
+        #changes are made and committed, in groups, by the coordinator's own session
+        self._commits = make_coordinator(Session)
         self._choices = {
             "1": self._open_account,
             "2": self._summary,
@@ -37,6 +54,20 @@ class BankCLI():
             "5": self._add_transaction,
             "6": self._monthly_triggers,
             "7": self._quit,
+            "8": self._import_transactions,
+            "9": self._month_end,
+            "10": self._stats,
+            "11": self._rebuild_snapshots,
+            "12": self._statements,
+        }
+        self._batch_commands = {
+            "open": self._batch_open,
+            "select": self._batch_select,
+            "add": self._batch_add,
+            "interest": self._batch_interest,
+            "month-end": self._batch_month_end,
+            "summary": self._batch_summary,
+            "list": self._batch_list,
         }
 
     def _display_menu(self):
@@ -49,7 +80,12 @@ Enter command
 4: list transactions
 5: add transaction
 6: interest and fees
-7: quit"""
+7: quit
+8: import transactions
+9: month-end for all accounts
+10: stats
+11: rebuild balance snapshots
+12: statements"""
         )
 
     def run(self):
@@ -64,8 +100,204 @@ Enter command
             else:
                 print("{0} is not a valid choice".format(choice))
 
+    def run_batch(self, lines, commit_every=BATCH_COMMIT_EVERY, out=sys.stdout):
+        """Runs commands from a script or stream instead of the menu, one per line, e.g.
+
+            open savings 100
+            select 3
+            add 50 2024-01-05
+            interest
+            month-end 2024-01
+            summary
+            list
+            commit
+
+        Everything runs in one session and is committed every commit_every commands
+        (and at each "commit" and the end). A result is written to out as one JSON
+        object per command once its batch has been saved: "ok" with the outcome, or
+        "error" with the exception name and the message the menu would show. Blank
+        lines and lines starting with # are skipped.
+
+        If another process changed the same accounts first, the batch is rolled back
+        and run again from the selection it started with, like the menu's commands.
+        If it still conflicts, or fails in an unexpected way, it is rolled back and
+        every command in it is reported as failed; the following commands still run.
+
+        Args:
+            lines (iterable): command lines
+            commit_every (int, optional): commands per commit. Defaults to 1000.
+            out (file, optional): where the results are written. Defaults to stdout.
+
+        Returns:
+            int: number of commands that failed
+        """
+        # keep the loaded accounts and their indexes across commits; a write based on data
+        # another process has since changed still fails the version check and is retried
+        self._session.expire_on_commit = False
+        batch = []
+        failed = 0
+
+        def flush():
+            nonlocal failed
+            start = self._selected_account._account_number if self._selected_account is not None else None
+
+            def replay():
+                self._selected_account = None if start is None else self._bank.get_account(start)
+                return [self._run_command(number, line) for number, line in batch]
+            try:
+                results = commit_with_retry(self._session, replay)
+            except Exception as e:
+                # nothing in the batch was saved, so every command in it failed
+                self._session.rollback()
+                self._selected_account = None if start is None else self._bank.get_account(start)
+                if isinstance(e, ConcurrentUpdateError):
+                    message = CONFLICT_MESSAGE
+                else:
+                    message = UNEXPECTED_MESSAGE
+                    logging.error("%s: %r", e.__class__.__name__, str(e))
+                results = [{"line": number, "command": line.split()[0].lower(), "ok": False,
+                            "error": e.__class__.__name__, "message": message}
+                           for number, line in batch]
+            else:
+                logging.debug("Saved to bank.db")
+            for r in results:
+                failed += not r["ok"]
+                out.write(json.dumps(r) + "\n")
+            batch.clear()
+
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.lower() == "commit":
+                flush()
+                out.write(json.dumps({"line": number, "command": "commit", "ok": True}) + "\n")
+                continue
+            batch.append((number, line))
+            if len(batch) >= commit_every:
+                flush()
+        flush()
+        out.flush()
+        return failed
+
+    def _run_command(self, number, line):
+        """Runs one batch command and describes the outcome"""
+        words = line.split()
+        name = words[0].lower()
+        result = {"line": number, "command": name, "ok": True}
+        try:
+            handler = self._batch_commands.get(name)
+            if handler is None:
+                raise CommandError(f"Unknown command {name!r}.")
+            result.update(handler(*words[1:]))
+        except (CommandError, InvalidAmountError, UnknownAccountError, OverdrawError, TransactionLimitError,
+                TransactionSequenceError) as e:
+            result.update(ok=False, error=e.__class__.__name__, message=self._describe(e, name))
+            if isinstance(e, TransactionSequenceError):
+                result["latest_date"] = e.latest_date.isoformat()
+        return result
+
+    @staticmethod
+    def _describe(e, command):
+        """The message the menu shows for an error"""
+        if isinstance(e, OverdrawError):
+            return "This transaction could not be completed due to an insufficient account balance."
+        if isinstance(e, TransactionLimitError):
+            return "This transaction could not be completed because the account has reached a transaction limit."
+        if isinstance(e, TransactionSequenceError) and command == "interest":
+            return f"Cannot apply interest and fees again in the month of {e.latest_date.strftime('%B')}."
+        if isinstance(e, TransactionSequenceError):
+            return f"New transactions must be from {e.latest_date} onward."
+        if isinstance(e, UnknownAccountError):
+            return f"No account #{e.account_number:09}."
+        if isinstance(e, InvalidAmountError):
+            return INVALID_AMOUNT_MESSAGE
+        return str(e)
+
+    @staticmethod
+    def _parse(value, parse, what):
+        # amounts are parsed with to_money, whose InvalidAmountError (NaN, infinities and
+        # amounts too large to store) is a ValueError, so they fail only their own command
+        try:
+            return parse(value)
+        except ValueError:
+            raise CommandError(f"Please try again with {what}.")
+
+    def _selected(self):
+        if self._selected_account is None:
+            raise CommandError("This command requires that you first select an account.")
+        return self._selected_account
+
+    def _batch_open(self, acct_type=None, amount=None, *extra):
+        if amount is None or extra:
+            raise CommandError("Usage: open <savings|checking> <amount>")
+        amt = self._parse(amount, to_money, "a valid dollar amount")
+        account = self._bank.add_account(acct_type.lower(), amt, self._session)
+        if account is None:
+            raise CommandError("The account type must be savings or checking.")
+        return {"account_number": account._account_number, "balance": str(account.get_balance())}
+
+    def _batch_select(self, number=None, *extra):
+        if number is None or extra:
+            raise CommandError("Usage: select <account number>")
+        num = self._parse(number, int, "a whole account number")
+        account = self._bank.get_account(num)
+        if account is None:
+            raise UnknownAccountError(num)
+        self._selected_account = account
+        return {"account_number": num}
+
+    def _batch_add(self, amount=None, date=None, *extra):
+        if amount is None or extra:
+            raise CommandError("Usage: add <amount> [YYYY-MM-DD]")
+        amt = self._parse(amount, to_money, "a valid dollar amount")
+        if date is not None:
+            date = self._parse(date, lambda d: datetime.strptime(d, "%Y-%m-%d").date(),
+                               "a valid date in the format YYYY-MM-DD")
+        account = self._selected()
+        account.add_transaction(amt, self._session, date)
+        return {"account_number": account._account_number, "balance": str(account.get_balance())}
+
+    def _batch_interest(self, *extra):
+        if extra:
+            raise CommandError("Usage: interest")
+        account = self._selected()
+        account.assess_interest_and_fees(self._session)
+        return {"account_number": account._account_number, "balance": str(account.get_balance())}
+
+    def _batch_month_end(self, month=None, *extra):
+        if month is None or extra:
+            raise CommandError("Usage: month-end <YYYY-MM>")
+        month = self._parse(month, lambda m: datetime.strptime(m, "%Y-%m").date(),
+                            "a valid month in the format YYYY-MM")
+        results = []
+        for r in self._bank.run_month_end(month, self._session):
+            result = {"account_number": r.account_number}
+            if r.error is not None:
+                result.update(error=r.error.__class__.__name__, latest_date=r.error.latest_date.isoformat())
+            else:
+                result.update(interest=str(r.interest), fee=None if r.fee is None else str(r.fee))
+            results.append(result)
+        return {"results": results}
+
+    def _batch_summary(self, *extra):
+        if extra:
+            raise CommandError("Usage: summary")
+        return {"accounts": [{"type": s.type, "account_number": s.account_number, "balance": str(s.balance)}
+                             for s in self._bank.summary(self._session)]}
+
+    def _batch_list(self, *extra):
+        if extra:
+            raise CommandError("Usage: list")
+        return {"transactions": [{"date": t.date.isoformat(), "amount": str(t.amt)}
+                                 for t in self._selected().get_transactions()]}
+
+    #make this session re-read what the coordinator committed
+    def _reload(self):
+        expire_accounts(self._session)
+
     def _summary(self):
-        for x in self._bank.show_accounts():
+        for x in self._bank.summary(self._session):
             print(x)
 
     def _quit(self):
@@ -75,9 +307,9 @@ Enter command
         amount = None
         while amount == None:
             try:
-                amount = Decimal(input("Amount?\n>"))
-            except InvalidOperation:
-                print("Please try again with a valid dollar amount.")
+                amount = to_money(input("Amount?\n>"))
+            except InvalidAmountError:
+                print(INVALID_AMOUNT_MESSAGE)
 
         date = None
         while not date:
@@ -87,10 +319,14 @@ Enter command
             except ValueError:
                 print("Please try again with a valid date in the format YYYY-MM-DD.")
 
+        bank_id = self._bank._id
         try:
-            self._selected_account.add_transaction(amount, self._session, date)
-            self._session.commit()
+            acct_num = self._selected_account._account_number
+            # another process may have written to the account since it was loaded; if so, check again and retry
+            self._commits.run(lambda session: session.get(Bank, bank_id).get_account(acct_num)
+                              .add_transaction(amount, session, date))
             logging.debug("Saved to bank.db")
+            self._reload()
         except AttributeError:
            print("This command requires that you first select an account.")
         except OverdrawError:
@@ -101,6 +337,10 @@ Enter command
                 "This transaction could not be completed because the account has reached a transaction limit.")
         except TransactionSequenceError as e:
             print(f"New transactions must be from {e.latest_date} onward.")
+        except InvalidAmountError:
+            print(INVALID_AMOUNT_MESSAGE)
+        except ConcurrentUpdateError:
+            print(CONFLICT_MESSAGE)
 
     def _open_account(self):
         acct_type = input("Type of account? (checking/savings)\n>")
@@ -108,51 +348,208 @@ Enter command
         while amt == None:
             initial_deposit = input("Initial deposit amount?\n>")
             try:
-                amt = Decimal(initial_deposit)
-            except InvalidOperation:
-                print("Please try again with a valid dollar amount.")
+                amt = to_money(initial_deposit)
+            except InvalidAmountError:
+                print(INVALID_AMOUNT_MESSAGE)
+        bank_id = self._bank._id
+
+        def job(session):
+            account = session.get(Bank, bank_id).add_account(acct_type, amt, session)
+            return account._account_number if account else None
         try:
-            self._bank.add_account(acct_type, amt, self._session)
-            self._session.commit()
+            self._commits.run(job)
             logging.debug("Saved to bank.db")
         except OverdrawError:
             print(
                 "This transaction could not be completed due to an insufficient account balance.")
+        except InvalidAmountError:
+            print(INVALID_AMOUNT_MESSAGE)
+        except ConcurrentUpdateError:
+            print(CONFLICT_MESSAGE)
+
+    def _import_transactions(self):
+        path = input("File to import? (.csv or .jsonl)\n>")
+        bank_id = self._bank._id
+        try:
+            rejected = self._commits.run(lambda session: session.get(Bank, bank_id).import_transactions(path, session))
+            logging.debug("Saved to bank.db")
+            self._reload()
+        except OSError:
+            print("Please try again with a readable .csv or .jsonl file.")
+            return
+        except ConcurrentUpdateError:
+            print(CONFLICT_MESSAGE)
+            return
+        for r in rejected:
+            if isinstance(r.error, OverdrawError):
+                reason = "insufficient account balance"
+            elif isinstance(r.error, TransactionLimitError):
+                reason = "the account has reached a transaction limit"
+            elif isinstance(r.error, TransactionSequenceError):
+                reason = f"transactions must be from {r.error.latest_date} onward"
+            elif isinstance(r.error, UnknownAccountError):
+                reason = "no such account"
+            elif isinstance(r.error, InvalidAmountError):
+                reason = "invalid amount"
+            else:
+                reason = "invalid account number, amount or date"
+            print(f"Row {r.row} rejected: {reason}.")
+        print(f"{len(rejected)} row(s) rejected.")
 
     def _select(self):
         num = int(input("Enter account number\n>"))
         self._selected_account = self._bank.get_account(num)
 
     def _monthly_triggers(self):
+        bank_id = self._bank._id
         try:
-            self._selected_account.assess_interest_and_fees(self._session)
-            self._session.commit()
+            acct_num = self._selected_account._account_number
+            self._commits.run(lambda session: session.get(Bank, bank_id).get_account(acct_num)
+                              .assess_interest_and_fees(session))
             logging.debug("Triggered fees and interest")
             logging.debug("Saved to bank.db")
+            self._reload()
         except AttributeError:
             print("This command requires that you first select an account.")
         except TransactionSequenceError as e:
             print(
                 f"Cannot apply interest and fees again in the month of {e.latest_date.strftime('%B')}.")
+        except InvalidAmountError:
+            print("The interest would make the balance too large to store.")
+        except ConcurrentUpdateError:
+            print(CONFLICT_MESSAGE)
+
+    def _month_end(self):
+        month = None
+        while not month:
+            try:
+                month = datetime.strptime(input("Month? (YYYY-MM)\n>"), "%Y-%m").date()
+            except ValueError:
+                print("Please try again with a valid month in the format YYYY-MM.")
+
+        bank_id = self._bank._id
+        try:
+            results = self._commits.run(lambda session: session.get(Bank, bank_id).run_month_end(month, session))
+        except ConcurrentUpdateError:
+            print(CONFLICT_MESSAGE)
+            return
+        self._reload()
+        logging.debug("Triggered month-end for all accounts")
+        logging.debug("Saved to bank.db")
+        for r in results:
+            if r.error is not None and (r.error.latest_date.year, r.error.latest_date.month) > (month.year, month.month):
+                print(f"#{r.account_number:09}: has transactions after {month.strftime('%B %Y')} (latest {r.error.latest_date}).")
+            elif r.error is not None:
+                print(f"#{r.account_number:09}: cannot apply interest and fees again in the month of {r.error.latest_date.strftime('%B')}.")
+            elif r.fee is not None:
+                print(f"#{r.account_number:09}: interest ${r.interest:,.2f}, fee ${r.fee:,.2f}")
+            else:
+                print(f"#{r.account_number:09}: interest ${r.interest:,.2f}")
+
+    def _rebuild_snapshots(self):
+        bank_id = self._bank._id
+        try:
+            count = self._commits.run(lambda session: session.get(Bank, bank_id).rebuild_snapshots(session))
+        except ConcurrentUpdateError:
+            print(CONFLICT_MESSAGE)
+            return
+        logging.debug("Saved to bank.db")
+        print(f"Rebuilt {count} balance snapshot(s) from the transaction history.")
+
+    def _statements(self):
+        month = None
+        while not month:
+            try:
+                month = datetime.strptime(input("Month? (YYYY-MM)\n>"), "%Y-%m").date()
+            except ValueError:
+                print("Please try again with a valid month in the format YYYY-MM.")
+        out_dir = input("Directory? (Enter for statements)\n>").strip() or "statements"
+
+        # imported here to keep the process pool machinery out of startup
+        from statements import export_statements, month_range
+
+        start, end = month_range(month)
+        # an engine of its own, so the export never touches the connections the menu and the coordinator use
+        engine = make_engine(self._session.get_bind().url.database)
+        try:
+            results = export_statements(engine, start, end, out_dir, self._bank._id,
+                                        workers=os.cpu_count() or 1)
+        except OSError:
+            print("Please try again with a directory that can be written to.")
+            return
+        finally:
+            engine.dispose()
+        print(f"Wrote statements for {len(results)} account(s) to {out_dir}.")
+
+    def _stats(self):
+        if not metrics.is_enabled():
+            if input("Metrics are off. Turn them on? (y/n)\n>").strip().lower() != "y":
+                return
+            metrics.enable()
+            print("Metrics are on. Choose stats again to see them.")
+            return
+        print(metrics.report())
+        profile = "stop" if metrics.is_profiling() else "start"
+        choice = input(f"p: {profile} profiling, d: save to file, r: reset, o: turn metrics off, Enter: back\n>").strip().lower()
+        if choice == "p" and metrics.is_profiling():
+            print(metrics.stop_profile("bank.prof"))
+            print("Profile saved to bank.prof.")
+        elif choice == "p":
+            # the menu's changes run on the coordinator's thread, so it is profiled too
+            metrics.start_profile(self._commits)
+            print("Profiling until stopped from this menu.")
+        elif choice == "d":
+            print(f"Metrics saved to {metrics.dump()}.")
+        elif choice == "r":
+            metrics.reset()
+        elif choice == "o":
+            metrics.disable()
 
     def _list_transactions(self):
         try:
-            for x in self._selected_account.get_transactions():
-                print(x)
+            # read the history a page at a time instead of loading it all into the session
+            offset = 0
+            while True:
+                page = self._selected_account.get_transactions(offset, TRANSACTION_PAGE_SIZE)
+                for x in page:
+                    print(x)
+                if len(page) < TRANSACTION_PAGE_SIZE:
+                    break
+                offset += TRANSACTION_PAGE_SIZE
         except AttributeError:
             print("This command requires that you first select an account.")
 
 
 if __name__ == "__main__":
 
-    engine = sqlalchemy.create_engine("sqlite:///bank.db")
-    Base.metadata.create_all(engine)
+    parser = argparse.ArgumentParser(description="Bank command line. Runs the menu unless --batch is given.")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the commands in FILE ('-' for stdin) and print JSON results, one line each")
+    parser.add_argument("--commit-every", type=int, default=BATCH_COMMIT_EVERY,
+                        help="commands per commit in batch mode (default %(default)s)")
+    args = parser.parse_args()
 
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    
+    configure_logging()
+    metrics.configure_metrics()
     try:
-        BankCLI().run()
+        init_db()
+    except (SchemaVersionError, MigrationError) as e:
+        logging.error("%s: %s", e.__class__.__name__, e)
+        sys.exit(str(e))
+
+    try:
+        if args.batch == "-":
+            sys.exit(1 if BankCLI().run_batch(sys.stdin, args.commit_every) else 0)
+        elif args.batch:
+            with open(args.batch) as script:
+                sys.exit(1 if BankCLI().run_batch(script, args.commit_every) else 0)
+        else:
+            BankCLI().run()
     except Exception as e:
-        print("Sorry! Something unexpected happened. If this problem persists please contact our support team for assistance.")
-        logging.error(str(e.__class__.__name__) + ": " + repr(str(e)))
+        logging.error("%s: %r", e.__class__.__name__, str(e))
+        if not args.batch:
+            print(UNEXPECTED_MESSAGE)
+        else:
+            # scripts read the results as JSON and check the exit status
+            print(json.dumps({"ok": False, "error": e.__class__.__name__, "message": UNEXPECTED_MESSAGE}))
+            sys.exit(1)
@@ -0,0 +1,36 @@
+from sqlalchemy import Column, Integer, Date, ForeignKey
+
+from Transactions import Base
+from money import Money
+
+
+class BalanceSnapshot(Base):
+    """The state of an account when a month was closed by assessing interest and fees.
+
+    An account's current state is its latest snapshot plus the transactions saved
+    after it (those with a larger _id), so checking a new transaction only needs
+    the activity since the last month-end instead of the whole history."""
+
+    __tablename__ = "balance_snapshot"
+    _id = Column(Integer, primary_key = True)
+    _account_id = Column(Integer, ForeignKey("account._id"), index = True)
+    # latest transaction date covered, the last day of the closed month
+    _date = Column(Date)
+    _balance = Column(Money)
+    # the snapshot covers exactly the account's transactions up to this id
+    _last_transaction_id = Column(Integer)
+    # non-exempt transactions on _date and in its month, for the savings limits
+    _day_count = Column(Integer)
+    _month_count = Column(Integer)
+
+    def __init__(self, account_id, date, balance, last_transaction_id, day_count, month_count):
+        self._account_id = account_id
+        self._date = date
+        self._balance = balance
+        self._last_transaction_id = last_transaction_id
+        self._day_count = day_count
+        self._month_count = month_count
+
+    @property
+    def date(self):
+        return self._date
@@ -1,14 +1,15 @@
 from datetime import datetime, date, timedelta
 import logging
-from decimal import Decimal, setcontext, BasicContext
+from decimal import Decimal
 import functools
-from sqlalchemy import Column,Float, Integer, Date, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, Date, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
+from money import Money, to_money, use_context
 
 Base = declarative_base()
 
-# context with ROUND_HALF_UP
-setcontext(BasicContext)
+# context with ROUND_HALF_UP, for the thread that imports the model
+use_context()
 
 
 @functools.total_ordering
@@ -16,25 +17,37 @@ class Transaction(Base):
 
     __tablename__ = "transaction"
     _id = Column(Integer, primary_key = "True")
-    _amt = Column(Float(asdecimal=True))
+    _amt = Column(Money)
     _account_id = Column(Integer, ForeignKey("account._id"))
-    _date = Column(Date)
+    _date = Column(Date, index = True)
     _exempt = Column(Boolean)
 
+    # serves both loading an account's transactions and date ranges within one account
+    __table_args__ = (
+        Index("ix_transaction__account_id__date", _account_id, _date),
+        # finds the transactions saved after an account's latest balance snapshot
+        Index("ix_transaction__account_id__id", _account_id, _id),
+    )
+
     def __init__(self, amt, acct_num, date=None, exempt=False):
         """
         Args:
-            amt (Decimal): Decimal object representing dollar amount of the transaction.
+            amt (Decimal): Decimal object representing dollar amount of the transaction. Rounded to whole cents.
             acct_num (int): Account number used for logging the transaction's creation.
             date (Date, optional): Date object representing the date the transaction was created.Defaults to None.
             exempt (bool, optional): Determines whether the transaction is exempt from account limits. Defaults to False.
+
+        Raises:
+            InvalidAmountError: amt is not a finite number or is too large to store in cents
         """
-        self._amt = amt
+        # amounts are stored in cents, so round now to keep cached balances equal to the stored ones
+        self._amt = to_money(amt)
         self._date = date
         if not self._date:
             self._date = datetime.now().date()
         self._exempt = exempt
-        logging.debug(f"Created transaction: {acct_num}, {self._amt}")
+        # lazy %-style arguments, so nothing is formatted unless DEBUG is enabled
+        logging.debug("Created transaction: %s, %s", acct_num, self._amt)
 
     @property
     def date(self):
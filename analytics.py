@@ -0,0 +1,299 @@
+"""Columnar analytics over a whole bank (needs NumPy: pip install numpy).
+
+Ledger loads the transaction table once into contiguous int64 arrays of account,
+day ordinal (date.toordinal()) and amount in integer cents, sorted by account and
+date, so daily balance series, average daily balances, month-end interest and
+totals by account type are cumulative sums and binary searches over the arrays
+instead of a Python Decimal per transaction. Every amount stays an exact integer,
+and interest is rounded the way the Decimal code rounds it, so the results agree
+with the Account objects to the cent. For example:
+
+    python analytics.py --accounts 200 --transactions 5000   # benchmark against the Account objects
+
+Only this module imports NumPy; the GUI, CLI and service run without it.
+"""
+import argparse
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+from itertools import chain
+
+import numpy as np
+from sqlalchemy import BigInteger, Integer, cast, func, select, type_coerce
+from sqlalchemy.orm import sessionmaker
+
+from Accounts import Account, SavingsAccount, CheckingAccount
+from Bank import Bank, SELECTIN
+from Transactions import Transaction
+from database import make_engine
+from migrations import upgrade
+from money import CONTEXT, to_money
+from statements import month_range
+
+# julianday() of 0001-01-01, so julianday(d) - JULIAN_DAY_OFFSET == d.toordinal()
+JULIAN_DAY_OFFSET = 1721424.5
+BATCH_SIZE = 100_000
+
+# keys combine an account's position and a day ordinal so one sorted array covers both
+_DAY_BITS = 32
+
+
+def _round_half_up(numerator, denominator):
+    "Integer division rounded half away from zero, like ROUND_HALF_UP, elementwise"
+    magnitude = (2 * np.abs(numerator) + denominator) // (2 * denominator)
+    return np.sign(numerator) * magnitude
+
+
+def interest_cents(balances, rates):
+    """Interest on balances, rounded exactly as to_money(balance * rate) rounds it.
+
+    The product of cents and millionths is exact in units of 10**-8 dollars, as the
+    Decimal product is in money.CONTEXT, and is rounded half up to cents.
+
+    Args:
+        balances (ndarray): balances in cents
+        rates (ndarray): interest rates in millionths
+
+    Returns:
+        ndarray: interest in cents
+
+    Raises:
+        OverflowError: a product does not fit in 64 bits (about $90 billion at a rate of 100%)
+    """
+    balances = np.asarray(balances, dtype=np.int64)
+    rates = np.asarray(rates, dtype=np.int64)
+    if len(balances) and np.abs(balances).max() > np.iinfo(np.int64).max // max(int(np.abs(rates).max()), 1):
+        raise OverflowError("balance * rate does not fit in 64 bits")
+    return _round_half_up(balances * rates, 10 ** 6)
+
+
+def to_dollars(cents):
+    "Converts integer cents to a Decimal amount, as Money does"
+    return Decimal(int(cents)).scaleb(-2, CONTEXT)
+
+
+class Ledger():
+    """Every transaction of a bank (or of all banks) as parallel NumPy arrays.
+
+    Per-account results are arrays in the order of account_numbers; by_account()
+    turns one into a dict of Decimal amounts. The ledger is a snapshot; load it
+    again to see later transactions."""
+
+    def __init__(self, account_ids, account_numbers, account_types, rates, accounts, days, cents):
+        """
+        Args:
+            account_ids (ndarray): account ids, ascending
+            account_numbers (ndarray): account numbers, in the same order
+            account_types (ndarray): "savings" or "checking", in the same order
+            rates (ndarray): interest rates in millionths, in the same order
+            accounts (ndarray): position in account_ids of each transaction's account
+            days (ndarray): day ordinal of each transaction
+            cents (ndarray): amount of each transaction in cents, sorted by account and day like days
+        """
+        self.account_ids = account_ids
+        self.account_numbers = account_numbers
+        self.account_types = account_types
+        self.rates = rates
+        self.days = days
+        self.cents = cents
+        self._keys = (accounts << _DAY_BITS) | days
+        # _sums[i] is the total of the first i transactions, so a range's total is a difference
+        self._sums = np.concatenate(([0], np.cumsum(cents)))
+        self._starts = np.searchsorted(self._keys, np.arange(len(account_ids), dtype=np.int64) << _DAY_BITS)
+
+    @classmethod
+    def load(cls, session, bank_id=None, batch_size=BATCH_SIZE):
+        """Reads the transactions into arrays, batch_size rows at a time, without creating ORM objects.
+
+        Args:
+            session (Session): session to read with
+            bank_id (int, optional): only this bank's accounts. Defaults to None (every account).
+            batch_size (int, optional): rows fetched per round trip. Defaults to 100,000.
+
+        Returns:
+            Ledger: the loaded ledger
+        """
+        account = Account.__table__
+        savings = SavingsAccount.__table__
+        checking = CheckingAccount.__table__
+        transaction = Transaction.__table__
+        # the raw integers behind Money and Rate, so nothing passes through Decimal
+        accounts = (select(account.c._id, account.c._account_number, account.c._type,
+                           type_coerce(func.coalesce(savings.c._interest_rate, checking.c._interest_rate, 0),
+                                       BigInteger))
+                    .outerjoin(savings, savings.c._id == account.c._id)
+                    .outerjoin(checking, checking.c._id == account.c._id)
+                    .order_by(account.c._id))
+        rows = (select(transaction.c._account_id,
+                       cast(func.julianday(transaction.c._date) - JULIAN_DAY_OFFSET, Integer),
+                       type_coerce(transaction.c._amt, BigInteger))
+                .order_by(transaction.c._account_id, transaction.c._date, transaction.c._id))
+        if bank_id is not None:
+            accounts = accounts.where(account.c._bank_id == bank_id)
+            rows = rows.where(transaction.c._account_id.in_(select(account.c._id)
+                                                            .where(account.c._bank_id == bank_id)))
+
+        metadata = session.execute(accounts).all()
+        ids, numbers, types, rates = zip(*metadata) if metadata else ((),) * 4
+        result = session.execute(rows.execution_options(yield_per=batch_size))
+        # fromiter reads the row values directly; np.array() would probe every Row for array attributes
+        chunks = [np.fromiter(chain.from_iterable(batch), dtype=np.int64, count=3 * len(batch)).reshape(-1, 3)
+                  for batch in result.partitions()]
+        table = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int64)
+        account_ids = np.array(ids, dtype=np.int64)
+        return cls(account_ids, np.array(numbers, dtype=np.int64), np.array(types, dtype=object),
+                   np.array(rates, dtype=np.int64), np.searchsorted(account_ids, table[:, 0]),
+                   np.ascontiguousarray(table[:, 1]), np.ascontiguousarray(table[:, 2]))
+
+    def __len__(self):
+        return len(self.cents)
+
+    def balances(self, as_of):
+        """Gets every account's balance at the end of a day.
+
+        Args:
+            as_of (Date): day to take the balances at
+
+        Returns:
+            ndarray: balance of each account in cents
+        """
+        return self.daily_balances(as_of, as_of)[:, 0]
+
+    def daily_balances(self, start, end):
+        """Gets every account's balance at the end of each day of a period.
+
+        Args:
+            start (Date): first day
+            end (Date): last day
+
+        Returns:
+            ndarray: accounts x days balances in cents
+        """
+        days = np.arange(start.toordinal(), end.toordinal() + 1, dtype=np.int64)
+        positions = np.arange(len(self.account_ids), dtype=np.int64)
+        keys = (positions[:, None] << _DAY_BITS) | days[None, :]
+        # how many of the account's transactions fall on or before each day
+        ends = np.searchsorted(self._keys, keys, side="right")
+        return self._sums[ends] - self._sums[self._starts][:, None]
+
+    def average_daily_balances(self, start, end):
+        """Gets every account's average end-of-day balance over a period, like
+        Account.average_daily_balance.
+
+        Returns:
+            ndarray: average balance of each account in cents, rounded half up
+        """
+        totals = self.daily_balances(start, end).sum(axis=1)
+        return _round_half_up(totals, (end - start).days + 1)
+
+    def month_end_interest(self, month, average=False):
+        """Gets the interest every account earns for a month.
+
+        By default the interest is on the balance at the end of the month, as
+        Account.assess_interest_and_fees and Bank.run_month_end charge it; with
+        average=True it is on the average daily balance over the month instead.
+        Fees are not included.
+
+        Args:
+            month (Date): any day in the month
+            average (bool, optional): use the average daily balance. Defaults to False.
+
+        Returns:
+            ndarray: interest of each account in cents
+        """
+        first, last = month_range(month)
+        balances = self.average_daily_balances(first, last) if average else self.balances(last)
+        return interest_cents(balances, self.rates)
+
+    def totals_by_type(self, as_of):
+        """Sums the balances at the end of a day by account type.
+
+        Returns:
+            dict: account type -> total balance (Decimal)
+        """
+        balances = self.balances(as_of)
+        types, groups = np.unique(self.account_types.astype(str), return_inverse=True)
+        totals = np.zeros(len(types), dtype=np.int64)
+        np.add.at(totals, groups, balances)
+        return {t: to_dollars(total) for t, total in zip(types, totals)}
+
+    def by_account(self, cents):
+        """Pairs a per-account result with the account numbers.
+
+        Returns:
+            dict: account number -> amount (Decimal)
+        """
+        return {int(n): to_dollars(c) for n, c in zip(self.account_numbers, cents)}
+
+
+def main(argv=None):
+    """Times the ledger against the Account objects on a synthetic bank and checks they agree to the cent"""
+    from benchmarks import generate_bank
+
+    parser = argparse.ArgumentParser(description="Benchmark the columnar ledger against the Account objects.")
+    parser.add_argument("--db", help="existing database to read (default: build a synthetic bank in memory)")
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=2000, help="per account")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--month", help="month to compute, as YYYY-MM (default: the month of the median transaction)")
+    args = parser.parse_args(argv)
+
+    engine = make_engine(args.db or ":memory:")
+    with sessionmaker(bind=engine)() as session:
+        if args.db is None:
+            upgrade(engine)
+            print(f"Building {args.accounts}x{args.transactions} bank...")
+            generate_bank(session, args.accounts, args.transactions, args.seed)
+            session.commit()
+        bank_id = session.scalar(select(func.min(Account._bank_id)))
+
+        began = time.perf_counter()
+        ledger = Ledger.load(session, bank_id)
+        loaded = time.perf_counter() - began
+        if not len(ledger):
+            print("No transactions")
+            return 0
+        month = (date.fromisoformat(args.month + "-01") if args.month
+                 else date.fromordinal(int(np.median(ledger.days))))
+        first, last = month_range(month)
+        began = time.perf_counter()
+        vector = {
+            "average daily balance": ledger.by_account(ledger.average_daily_balances(first, last)),
+            "interest on closing balance": ledger.by_account(ledger.month_end_interest(month)),
+            "interest on average balance": ledger.by_account(ledger.month_end_interest(month, average=True)),
+        }
+        vector_time = time.perf_counter() - began
+        print(f"Ledger: {len(ledger)} transactions loaded in {loaded:.2f} s, {first:%Y-%m} computed in "
+              f"{vector_time * 1e3:.1f} ms")
+
+        # the per-object Decimal path the ledger has to match
+        session.expunge_all()
+        began = time.perf_counter()
+        bank = session.get(Bank, bank_id)
+        accounts = bank.load_accounts(session, transactions=SELECTIN)
+        loaded = time.perf_counter() - began
+        began = time.perf_counter()
+        reference = {name: {} for name in vector}
+        for a in accounts:
+            adb = a.average_daily_balance(first, last)
+            reference["average daily balance"][a._account_number] = adb
+            reference["interest on closing balance"][a._account_number] = \
+                to_money(a.get_balance(as_of=last) * a._interest_rate)
+            reference["interest on average balance"][a._account_number] = to_money(adb * a._interest_rate)
+        decimal_time = time.perf_counter() - began
+        print(f"Accounts: {len(accounts)} loaded in {loaded:.2f} s, {first:%Y-%m} computed in "
+              f"{decimal_time * 1e3:.1f} ms ({decimal_time / vector_time:.0f}x the ledger)")
+
+    mismatches = 0
+    for name, expected in reference.items():
+        wrong = [n for n in expected if expected[n] != vector[name].get(n)]
+        mismatches += len(wrong)
+        print(f"  {name:<28} {len(expected) - len(wrong)}/{len(expected)} accounts match"
+              + (f"; first mismatch on account {wrong[0]}: {expected[wrong[0]]} != {vector[name].get(wrong[0])}"
+                 if wrong else ""))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,49 +1,42 @@
+import os
 import sys
 import logging
-from decimal import Decimal, InvalidOperation
 from datetime import datetime
-from turtle import bgcolor, width
-import sqlalchemy
-from sqlalchemy.orm.session import sessionmaker
-from Transactions import Base
 from Bank import Bank
-from Accounts import OverdrawError, TransactionLimitError, TransactionSequenceError
-from megawidgets import TransactionGrid
+from Accounts import OverdrawError, TransactionLimitError, TransactionSequenceError, ConcurrentUpdateError, expire_accounts
+from megawidgets import TransactionGrid, AccountList
+from worker import DatabaseWorker
+from logconfig import configure_logging
+from migrations import SchemaVersionError, MigrationError
+from database import Session, init_db
+from money import InvalidAmountError, to_money
+import metrics
 import tkinter as tk
 from tkinter import DISABLED, messagebox
 from tkinter import ttk
-from tkcalendar import Calendar
+
+CONFLICT_MESSAGE = "The account was changed by another user at the same time. Please try again."
+INVALID_AMOUNT_MESSAGE = "Please try again with a valid dollar amount."
+
+# set by startup.py: report when the window and the accounts first appear, then quit
+STARTUP_PROBE = os.environ.get("BANK_STARTUP_PROBE")
 
 # define a callback function that handles exceptions
 def handle_exception(exception, value, traceback):
     messagebox.showwarning('Unhandled Exception', "Sorry! Something unexpected happened. If this problem persists please contact our support team for assistance.")
-    logging.error(f"{exception.__name__}: {repr(value)}")
+    logging.error("%s: %r", exception.__name__, value)
     sys.exit(1)
 
-logging.basicConfig(filename='bank.log', level=logging.DEBUG,
-                    format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
 
 class BankGUI():
     def __init__(self):
         self._session = Session()
-        
-        #get bank from db
-        self._bank = self._session.query(Bank).first()
-
-        #if bank does not exist then initialize and save a new bank
-        if self._bank:
-            logging.debug("Loaded from bank.db")     
-        else:
-            self._bank = Bank()
-            self._session.add(self._bank)
-            self._session.commit()
-            logging.debug("Saved to bank.db") 
 
+        #the bank is loaded by the worker once the window is up
+        self._bank = None
         self._selected_account = None
 
-        #store account and transaction buttons in lists
-        self._account_list = []
+        #start with no transactions listed
         self._transaction_list = []
         
         #create a root with title Bank
@@ -75,9 +68,22 @@ class BankGUI():
         
         #create megawidget for displaying transactions
         self._trans_grid = TransactionGrid(self._list_transactions_frame, self._transaction_list)
+        self._trans_grid.pack(padx=5)
+
+        #create megawidget for displaying and finding accounts
+        self._account_list = AccountList(self._summary_frame, self._select)
+        self._account_list.pack(fill = tk.BOTH, expand = True)
+
+        #database work runs on a background thread and is committed in groups
+        self._worker = DatabaseWorker(self._window, Session, on_busy=self._show_pending)
 
-        self._summary()
+        #show the window first and fill in the accounts when they have been read
+        self._open_acc_btn['state'] = tk.DISABLED
+        self._worker.submit(self._load_bank, self._bank_loaded)
+        if STARTUP_PROBE:
+            self._window.after_idle(lambda: print("first frame", flush=True))
         self._window.mainloop()
+        self._worker.stop()
 
     #style the main root window
     def _window_style(self):
@@ -98,12 +104,27 @@ class BankGUI():
 
         #create buttons for add account, add transaction and interest and fees
         self._open_acc_btn = tk.Button(self._options_frame, text="Open Account", width= 18, activebackground='blue',
-                                    command=self._open_account_gui ).pack( padx=5, pady=15, side=tk.LEFT)
+                                    command=self._open_account_gui )
+        self._open_acc_btn.pack( padx=5, pady=15, side=tk.LEFT)
         self._add_transc_btn = tk.Button(self._options_frame, text="Add Transaction", width= 18, state = tk.NORMAL,
                                     command=self._add_transaction_gui)
         self._add_transc_btn.pack(padx=5, pady=15, side=tk.LEFT)
         self._monthly_trig_btn = tk.Button(self._options_frame, text="Interest and Fees", width= 18,
-                                    command=self._monthly_triggers).pack(padx=5, pady=15, side=tk.LEFT)
+                                    command=self._monthly_triggers)
+        self._monthly_trig_btn.pack(padx=5, pady=15, side=tk.LEFT)
+
+        #shows that changes are still being saved
+        self._status_label = tk.Label(self._options_frame, text="", width= 10, fg='grey')
+        self._status_label.pack(padx=5, pady=15, side=tk.LEFT)
+
+    #pending state while the worker has unsaved changes
+    def _show_pending(self, pending):
+        self._status_label['text'] = "Saving..." if pending else ""
+        self._window['cursor'] = "watch" if pending else ""
+
+    #make the UI session re-read what the worker committed
+    def _reload(self):
+        expire_accounts(self._session)
     
 
     #method to display widgets for adding transaction
@@ -124,9 +145,9 @@ class BankGUI():
         #check validity of amount
         def validation_check():
             try:
-                amount = Decimal(e1.get())
-            except InvalidOperation:
-                messagebox.showwarning('Invalid Decimal', 'Please try again with a valid dollar amount.')
+                amount = to_money(e1.get())
+            except InvalidAmountError:
+                messagebox.showwarning('Invalid Decimal', INVALID_AMOUNT_MESSAGE)
             else:
                 add_callback(amount)
                 
@@ -141,8 +162,6 @@ class BankGUI():
             l2.destroy()
             calender.destroy()
             self._add_transaction_frame.grid_forget()
-            self._list_transactions()
-            self._summary()
             self._add_transc_btn['state'] = tk.NORMAL
 
 
@@ -170,10 +189,11 @@ class BankGUI():
         l2 = tk.Label(self._add_transaction_frame, text="Date:", font= "Arial 12" )
         l2.pack()
 
+        #imported on first use; the calendar widget is slow to import
+        from tkcalendar import Calendar
+
         #calender for date input
-        calender_date = datetime.today()
-        if self._selected_account.get_transactions():
-            calender_date = max(self._selected_account.get_transactions()).date
+        calender_date = self._selected_account.get_latest_date() or datetime.today()
         calender = Calendar(self._add_transaction_frame, selectmode='day', locale='en_US',
                     month=calender_date.month, day=calender_date.day, year=calender_date.year)
         calender.pack()
@@ -184,20 +204,38 @@ class BankGUI():
     
     #method to process GUI input for adding transaction
     def _add_transaction(self, amount, date):
-        try:
-            self._selected_account.add_transaction(amount, self._session, date)
-            self._session.commit()
+        bank_id = self._bank._id
+        acct_num = self._selected_account._account_number
+
+        #committed by the worker; if another process wrote to the account first the rules are checked again
+        def job(session):
+            session.get(Bank, bank_id).get_account(acct_num).add_transaction(amount, session, date)
+
+        def done(result):
             logging.debug("Saved to bank.db")
+            self._reload()
+            self._list_transactions()
+            self._trans_grid.scroll_to_end()
+            self._refresh_accounts(acct_num)
+
+        def failed(e):
+            if isinstance(e, OverdrawError):
+                messagebox.showwarning('Insufficient Balance', 
+                    "This transaction could not be completed due to an insufficient account balance.")
+            elif isinstance(e, TransactionLimitError):
+                messagebox.showwarning('Transaction Limit reached',
+                    "This transaction could not be completed because the account has reached a transaction limit.")
+            elif isinstance(e, TransactionSequenceError):
+                messagebox.showwarning('Invalid Date',
+                f"New transactions must be from {e.latest_date} onward.")
+            elif isinstance(e, InvalidAmountError):
+                messagebox.showwarning('Invalid Decimal', INVALID_AMOUNT_MESSAGE)
+            elif isinstance(e, ConcurrentUpdateError):
+                messagebox.showwarning('Account Busy', CONFLICT_MESSAGE)
+            else:
+                raise e
 
-        except OverdrawError:
-            messagebox.showwarning('Insufficient Balance', 
-                "This transaction could not be completed due to an insufficient account balance.")
-        except TransactionLimitError:
-            messagebox.showwarning('Transaction Limit reached',
-                "This transaction could not be completed because the account has reached a transaction limit.")
-        except TransactionSequenceError as e:
-            messagebox.showwarning('Invalid Date',
-            f"New transactions must be from {e.latest_date} onward.")
+        self._worker.submit(job, done, failed)
 
 
      #method to display widgets for opening account
@@ -208,9 +246,9 @@ class BankGUI():
         #validate entry amount as decimal
         def validate_amount():
             try:
-                amount = Decimal(e1.get())
-            except InvalidOperation:
-                messagebox.showwarning('Account Creation Failed', 'Please try again with a valid dollar amount.')
+                amount = to_money(e1.get())
+            except InvalidAmountError:
+                messagebox.showwarning('Account Creation Failed', INVALID_AMOUNT_MESSAGE)
             else:
                 add_callback(amount)
 
@@ -223,7 +261,6 @@ class BankGUI():
             l2.destroy()
             type_drop.destroy()
             self._open_account_frame.grid_forget()
-            self._summary()
 
         #label for dropdown account type
         l1 = tk.Label(self._open_account_frame, text="Type of account:")
@@ -262,13 +299,28 @@ class BankGUI():
         b1.grid(row=0, column=2, rowspan= 2)
 
     def _open_account(self, acct_type, amt):
+        bank_id = self._bank._id
 
-        try:
-            self._bank.add_account(acct_type, amt, self._session)
-            self._session.commit()
+        def job(session):
+            account = session.get(Bank, bank_id).add_account(acct_type, amt, session)
+            return account._account_number if account else None
+
+        def done(acct_num):
             logging.debug("Saved to bank.db")
-        except OverdrawError:
-            messagebox.showwarning('Account Creation Failed', 'This transaction could not be completed due to an insufficient account balance.')
+            if acct_num is not None:
+                self._refresh_accounts(acct_num)
+
+        def failed(e):
+            if isinstance(e, OverdrawError):
+                messagebox.showwarning('Account Creation Failed', 'This transaction could not be completed due to an insufficient account balance.')
+            elif isinstance(e, InvalidAmountError):
+                messagebox.showwarning('Account Creation Failed', INVALID_AMOUNT_MESSAGE)
+            elif isinstance(e, ConcurrentUpdateError):
+                messagebox.showwarning('Account Creation Failed', CONFLICT_MESSAGE)
+            else:
+                raise e
+
+        self._worker.submit(job, done, failed)
 
     def _select(self, num):
         self._selected_account = self._bank.get_account(num)
@@ -276,46 +328,79 @@ class BankGUI():
 
     def _list_transactions(self):
 
-        self._trans_grid.destroyer()
-
-        t = self._selected_account.get_transactions()
+        #the grid pages through the history itself, so only the rows in view are loaded
+        account = self._selected_account
         self._list_transactions_frame.tkraise()
-        self._trans_grid = TransactionGrid(self._list_transactions_frame, t)
+        self._trans_grid.set_source(account.get_transactions, account.count_transactions())
 
     #process interest and fees from the monthly triggers button
     def _monthly_triggers(self):
-        try:
-            self._selected_account.assess_interest_and_fees(self._session)
-            self._session.commit()
+        if self._selected_account is None:
+            messagebox.showwarning('Account not selected', 'This command requires that you first select an account.')
+            return
+        bank_id = self._bank._id
+        acct_num = self._selected_account._account_number
+
+        def job(session):
+            session.get(Bank, bank_id).get_account(acct_num).assess_interest_and_fees(session)
+
+        def done(result):
             logging.debug("Triggered fees and interest")
             logging.debug("Saved to bank.db")
-        except AttributeError:
-            messagebox.showwarning('Account not selected', 'This command requires that you first select an account.')
-        except TransactionSequenceError as e:
-            messagebox.showwarning('Interest already applied', f"Cannot apply interest and fees again in the month of {e.latest_date.strftime('%B')}.")
-        else:
+            self._reload()
             self._list_transactions()
-            self._summary()
+            self._refresh_accounts(acct_num)
+
+        def failed(e):
+            if isinstance(e, TransactionSequenceError):
+                messagebox.showwarning('Interest already applied', f"Cannot apply interest and fees again in the month of {e.latest_date.strftime('%B')}.")
+            elif isinstance(e, InvalidAmountError):
+                messagebox.showwarning('Interest not applied', "The interest would make the balance too large to store.")
+            elif isinstance(e, ConcurrentUpdateError):
+                messagebox.showwarning('Account Busy', CONFLICT_MESSAGE)
+            else:
+                raise e
 
-    #display accounts in GUI            
-    def _summary(self):
+        self._worker.submit(job, done, failed)
 
-        for x in self._account_list:
-            x.destroy()
-        
-        for x in self._bank.show_accounts():
-            acc_btn = tk.Radiobutton(self._summary_frame, text = x, 
-                        command=lambda num = x._account_number: self._select(num),
-                        value = x._account_number, indicator = 0, width = 30,
-                        background = "light blue", activebackground ='white')
-            acc_btn.pack(fill = tk.X, ipady = 5, padx = 5)
-            self._account_list.append(acc_btn)
+    #get or create the bank and summarize its accounts, on the worker thread
+    @staticmethod
+    def _load_bank(session):
+        bank = session.query(Bank).first()
+
+        #if bank does not exist then initialize and save a new bank
+        if bank:
+            logging.debug("Loaded from bank.db")
+        else:
+            #saved when the worker commits
+            bank = Bank()
+            session.add(bank)
+            session.flush()
+            logging.debug("Saved to bank.db")
+        return bank._id, bank.summary(session)
+
+    #display accounts in GUI
+    def _bank_loaded(self, result):
+        bank_id, accounts = result
+        self._bank = self._session.get(Bank, bank_id)
+        self._account_list.set_accounts(accounts)
+        self._open_acc_btn['state'] = tk.NORMAL
+        if STARTUP_PROBE:
+            print("accounts shown", flush=True)
+            self._window.destroy()
+
+    #redraw only the accounts that changed
+    def _refresh_accounts(self, *account_numbers):
+        self._account_list.update_accounts(self._bank.summary(self._session, account_numbers))
 
 
 if __name__ == "__main__":
 
-    engine = sqlalchemy.create_engine("sqlite:///bank.db")
-    Base.metadata.create_all(engine)
-    Session = sessionmaker()
-    Session.configure(bind=engine)
+    configure_logging()
+    metrics.configure_metrics()
+    try:
+        init_db()
+    except (SchemaVersionError, MigrationError) as e:
+        logging.error("%s: %s", e.__class__.__name__, e)
+        sys.exit(str(e))
     BankGUI()
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""Microbenchmarks for the domain model hot paths.
+
+Builds seeded synthetic banks in memory at several scales, times the core operations
+and writes the results as JSON. Runs headless (no Tk). For example:
+
+    python benchmarks.py --scales 10x100,100x1000 --output bench.json
+    python benchmarks.py --compare bench.json --threshold 0.25
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+import sqlalchemy
+from sqlalchemy import insert, select, update, func
+from sqlalchemy.orm import sessionmaker
+
+from Transactions import Transaction
+from Accounts import Account, SavingsAccount, CheckingAccount, expire_accounts
+from Bank import Bank, SAVINGS
+from database import make_engine
+from migrations import upgrade
+
+DEFAULT_SCALES = "10x100,100x100,10x2000"
+FIRST_DATE = date(2020, 1, 1)
+
+
+def generate_bank(session, num_accounts, num_transactions, seed=0):
+    """Fills an empty database with a synthetic bank.
+
+    Accounts alternate between savings and checking. Every account gets an initial
+    deposit and then num_transactions - 1 more transactions that respect the balance,
+    savings limit and date order rules, so the data behaves like real history. The
+    rows are bulk inserted, so large banks build quickly.
+
+    Args:
+        num_accounts (int): number of accounts to create
+        num_transactions (int): transactions per account, including the initial deposit
+        seed (int, optional): random seed; the same seed always builds the same bank. Defaults to 0.
+
+    Returns:
+        Bank: the new bank
+    """
+    rng = random.Random(seed)
+    bank = Bank()
+    session.add(bank)
+    session.flush()
+    for num in range(1, num_accounts + 1):
+        a = SavingsAccount(num) if num % 2 else CheckingAccount(num)
+        a.bank = bank
+        session.add(a)
+    session.flush()
+
+    rows = []
+    ids = session.execute(select(Account._id, Account._type).where(Account._bank_id == bank._id)
+                          .order_by(Account._account_number)).all()
+    for account_id, acct_type in ids:
+        balance = Decimal(0)
+        for i in range(num_transactions):
+            if acct_type == SAVINGS:
+                # one transaction a day, five a month, stays inside the savings limits
+                month = i // 5
+                when = date(FIRST_DATE.year + month // 12, month % 12 + 1, i % 5 + 1)
+            else:
+                when = FIRST_DATE + timedelta(days=i)
+            amt = Decimal(rng.randint(500, 5000)) if i == 0 else Decimal(rng.randint(-5000, 10000)) / 100
+            if balance + amt < 0:
+                amt = -amt
+            balance += amt
+            rows.append({"_account_id": account_id, "_amt": amt, "_date": when, "_exempt": False})
+    if rows:
+        session.execute(insert(Transaction), rows)
+
+    account = Account.__table__
+    transaction = Transaction.__table__
+    session.execute(update(account).values(_balance=select(func.sum(transaction.c._amt))
+                                           .where(transaction.c._account_id == account.c._id)
+                                           .scalar_subquery()))
+    session.execute(update(Bank.__table__).where(Bank.__table__.c._id == bank._id)
+                    .values(_last_account_number=num_accounts))
+    session.commit()
+    return bank
+
+
+def _time(fn, repeat):
+    """Runs fn repeat times and returns the median seconds per run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def run_scale(num_accounts, num_transactions, seed=0, repeat=5):
+    """Builds a bank at one scale and times each operation.
+
+    Returns:
+        dict: operation name -> median seconds per operation
+    """
+    engine = make_engine(":memory:")
+    upgrade(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        generate_bank(session, num_accounts, num_transactions, seed)
+
+    rng = random.Random(seed)
+    numbers = list(range(1, num_accounts + 1))
+    results = {}
+
+    def fresh():
+        """A new session, so every run starts with nothing loaded"""
+        session = Session()
+        return session, session.query(Bank).first()
+
+    def get_account():
+        session, bank = fresh()
+        for n in rng.sample(numbers, len(numbers)):
+            bank.get_account(n)
+        session.close()
+    results["Bank.get_account"] = _time(get_account, repeat) / num_accounts
+
+    def per_account(op, accounts_of=None):
+        """Times op(session, account) over every account, loading the accounts beforehand"""
+        def run():
+            session, bank = fresh()
+            accounts = [a for a in bank.load_accounts(session) if accounts_of is None or isinstance(a, accounts_of)]
+            for a in accounts:
+                # history and indexes are loaded before timing starts
+                a.get_balance()
+                a.get_latest_date()
+            start = time.perf_counter()
+            for a in accounts:
+                op(session, a)
+            elapsed = time.perf_counter() - start
+            session.rollback()
+            session.close()
+            return elapsed / max(len(accounts), 1)
+        return sorted(run() for _ in range(repeat))[repeat // 2]
+
+    def add(session, a):
+        latest = a.get_latest_date()
+        # a new month, so savings limits never reject it
+        a.add_transaction(Decimal("1.00"), session, date(latest.year + 1, 1, 1))
+    results["Account.add_transaction"] = per_account(add)
+
+    def cold_balance(session, a):
+        expire_accounts(session)
+        a.get_balance()
+    results["Account.get_balance (cold)"] = per_account(cold_balance)
+    results["Account.get_balance"] = per_account(lambda session, a: a.get_balance())
+
+    def check_limits(session, a):
+        latest = a.get_latest_date()
+        a._check_limits(Transaction(Decimal("1.00"), a._account_number, date=date(latest.year + 1, 1, 1)))
+    results["SavingsAccount._check_limits"] = per_account(check_limits, SavingsAccount)
+
+    results["Account.assess_interest_and_fees"] = per_account(lambda session, a: a.assess_interest_and_fees(session))
+
+    def summary():
+        session, bank = fresh()
+        [str(x) for x in bank.summary(session)]
+        session.close()
+    results["Bank.summary (render)"] = _time(summary, repeat)
+
+    engine.dispose()
+    return results
+
+
+def run(scales, seed=0, repeat=5):
+    """Runs every scale and returns the JSON-ready results"""
+    results = {}
+    for scale in scales:
+        num_accounts, num_transactions = (int(x) for x in scale.lower().split("x"))
+        results[scale] = run_scale(num_accounts, num_transactions, seed, repeat)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "seed": seed,
+            "repeat": repeat,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def find_regressions(baseline, current, threshold):
+    """Compares two result files.
+
+    Args:
+        threshold (float): allowed slowdown, e.g. 0.25 for 25%
+
+    Returns:
+        list: (scale, operation, baseline seconds, current seconds) for every slower operation
+    """
+    regressions = []
+    for scale, ops in current["results"].items():
+        for op, seconds in ops.items():
+            before = baseline["results"].get(scale, {}).get(op)
+            if before and seconds > before * (1 + threshold):
+                regressions.append((scale, op, before, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the bank's domain model hot paths.")
+    parser.add_argument("--scales", default=DEFAULT_SCALES,
+                        help="comma-separated ACCOUNTSxTRANSACTIONS sizes (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement; the median is kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to check the results against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="slowdown that counts as a regression (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    report = run(args.scales.split(","), args.seed, args.repeat)
+    for scale, ops in report["results"].items():
+        print(scale)
+        for op, seconds in ops.items():
+            print(f"  {op:<36} {seconds * 1e6:12.1f} us")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(baseline, report, args.threshold)
+        for scale, op, before, after in regressions:
+            print(f"REGRESSION {scale} {op}: {before * 1e6:.1f} us -> {after * 1e6:.1f} us")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""Group commit for the front ends.
+
+With the WAL journal every commit waits for its own fsync, which limits a writer to
+a few hundred commits a second however small the work is. CommitCoordinator runs
+the front ends' database work on one background thread and commits it in groups,
+so a single fsync covers every operation that arrived while the previous commit
+was being written. A lone operation is committed straight away:
+
+    commits = make_coordinator(Session)
+    number = commits.run(lambda session: session.get(Bank, bank_id).add_account("savings", 100, session)._account_number)
+
+$BANK_COMMIT_MODE chooses "group" (the default) or "strict", one commit per operation
+as before, and $BANK_COMMIT_WINDOW_MS how long a group may wait for more work (by
+default it does not wait).
+"""
+import argparse
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import date
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from Accounts import Account, ConcurrentUpdateError
+from Bank import Bank, CHECKING
+from database import RETRYABLE_ERRORS, RETRY_ATTEMPTS, make_engine
+from migrations import upgrade
+from money import use_context
+
+COMMIT_MODES = ("group", "strict")
+DEFAULT_WINDOW_MS = 0
+DEFAULT_MAX_OPS = 64
+# banks and accounts the coordinator's session keeps loaded between groups, at most
+MAX_KEPT = 10_000
+
+
+class CommitCoordinator():
+    """Runs database jobs on a background thread and commits them in groups.
+
+    A job takes the coordinator's session and makes its changes without committing.
+    Jobs run in the order they were submitted. A group is every job waiting when the
+    coordinator is free, up to max_ops, so a single caller never waits for others
+    while concurrent callers share commits. With window_ms above 0 a group also waits
+    that long for more jobs. Only after the commit are the callers' futures resolved
+    with the jobs' return values or exceptions, so a result always means the work is saved.
+
+    If the commit conflicts with another writer the group is rolled back and run
+    again, like commit_with_retry, and if one job raises, or its changes cannot be
+    stored, the others are run again without it. Jobs must therefore be safe to repeat, and must not return ORM
+    objects, since they belong to the coordinator's session."""
+
+    def __init__(self, session_factory, window_ms=DEFAULT_WINDOW_MS, max_ops=DEFAULT_MAX_OPS, strict=False,
+                 attempts=RETRY_ATTEMPTS):
+        """
+        Args:
+            session_factory (callable): creates the coordinator thread's session, e.g. a sessionmaker
+            window_ms (float, optional): longest wait for more jobs once a group has started. Defaults to 0.
+            max_ops (int, optional): largest group. Defaults to 64.
+            strict (bool, optional): commit every job on its own, without waiting. Defaults to False.
+            attempts (int, optional): commits tried per group before giving up on a conflict. Defaults to 3.
+        """
+        self._window = 0 if strict else window_ms / 1000
+        self._max_ops = 1 if strict else max_ops
+        self._attempts = attempts
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(session_factory,),
+                                        name="CommitCoordinator", daemon=True)
+        self._thread.start()
+
+    @property
+    def strict(self):
+        "True if every job is committed on its own"
+        return self._max_ops == 1
+
+    def submit(self, job):
+        """Queues a job for the next group.
+
+        Args:
+            job (callable): takes the coordinator's session and makes the changes, without committing
+
+        Returns:
+            Future: resolves with the job's return value once it is committed, or with its exception
+        """
+        future = Future()
+        self._jobs.put((job, future))
+        return future
+
+    def run(self, job):
+        """Submits a job and waits until it is committed.
+
+        Returns:
+            the job's return value
+
+        Raises:
+            the job's exception, or ConcurrentUpdateError if its group kept conflicting with another writer
+        """
+        return self.submit(job).result()
+
+    def stop(self):
+        """Commits the queued jobs and ends the coordinator thread"""
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self, session_factory):
+        # the jobs must calculate exactly as they would on the thread that submitted them
+        use_context()
+        session = session_factory()
+        # keep the loaded accounts and their indexes between groups; a write based on data
+        # another process has since changed still fails the version check and is retried
+        session.expire_on_commit = False
+        # the session only holds weak references; keep the bank and accounts the jobs load or
+        # create, with their indexes, so later jobs do not read them again. A rollback lets
+        # them go, as it expires them anyway, and so does reaching MAX_KEPT
+        kept = []
+
+        def keep(session, instance):
+            if isinstance(instance, (Bank, Account)):
+                if len(kept) >= MAX_KEPT:
+                    kept.clear()
+                kept.append(instance)
+        event.listen(session, "loaded_as_persistent", keep)
+        event.listen(session, "pending_to_persistent", keep)
+        event.listen(session, "after_soft_rollback", lambda session, previous_transaction: kept.clear())
+        stopping = False
+        while not stopping:
+            item = self._jobs.get()
+            if item is None:
+                break
+            group = [item]
+            deadline = time.monotonic() + self._window
+            while len(group) < self._max_ops:
+                try:
+                    # with no window this only takes the jobs that queued up during the last commit
+                    item = self._jobs.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+            self._commit(session, group)
+        session.close()
+
+    def _commit(self, session, group):
+        """Runs a group's jobs and commits them, retrying conflicts, then resolves the futures.
+
+        The group is flushed once, at the commit. If the database refuses it, the group is
+        run again with a flush after every job, so only the job whose changes cannot be
+        stored fails."""
+        attempt = 1
+        # a lone job has nothing to be told apart from
+        isolate = len(group) == 1
+        while True:
+            outcomes = {}
+            try:
+                outcomes.update(self._apply(session, group, outcomes, isolate))
+                session.commit()
+                break
+            except RETRYABLE_ERRORS as e:
+                session.rollback()
+                if attempt == self._attempts:
+                    error = ConcurrentUpdateError(str(e))
+                    outcomes = {id(future): (False, error) for _, future in group}
+                    break
+                logging.info("Write conflict in a group of %d, retrying (attempt %d of %d): %s",
+                             len(group), attempt, self._attempts, e)
+                attempt += 1
+            except Exception as e:
+                session.rollback()
+                if not isolate:
+                    logging.info("A group of %d could not be saved, running it again job by job: %s: %s",
+                                 len(group), e.__class__.__name__, e)
+                    isolate = True
+                    continue
+                # e.g. the database stayed locked; nothing in the group was saved
+                outcomes = {id(future): (False, e) for _, future in group}
+                break
+        for _, future in group:
+            ok, value = outcomes[id(future)]
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _apply(self, session, group, failed, flush_each=False):
+        """Runs the jobs that have not failed. A failing job is recorded in failed and the
+        others are run again from a rollback, since its partial changes cannot be undone alone.
+
+        Args:
+            flush_each (bool, optional): flush after every job, so a job whose changes the
+                database refuses fails on its own. Defaults to False.
+
+        Returns:
+            dict: id(future) -> (True, return value) for every job that ran
+        """
+        while True:
+            results = {}
+            for job, future in group:
+                if id(future) in failed:
+                    continue
+                try:
+                    value = job(session)
+                    if flush_each:
+                        session.flush()
+                    results[id(future)] = (True, value)
+                except RETRYABLE_ERRORS:
+                    raise
+                except Exception as e:
+                    failed[id(future)] = (False, e)
+                    session.rollback()
+                    break
+            else:
+                return results
+
+
+def make_coordinator(session_factory, mode=None, window_ms=None):
+    """Creates a CommitCoordinator configured by the arguments or the environment.
+
+    Args:
+        session_factory (callable): creates the coordinator's session
+        mode (str, optional): "group" or "strict". Defaults to $BANK_COMMIT_MODE or "group".
+        window_ms (float, optional): group window. Defaults to $BANK_COMMIT_WINDOW_MS or 0.
+
+    Returns:
+        CommitCoordinator: the running coordinator
+    """
+    mode = mode or os.environ.get("BANK_COMMIT_MODE", "group")
+    if mode not in COMMIT_MODES:
+        raise ValueError(f"Unknown commit mode {mode!r}; expected one of {', '.join(COMMIT_MODES)}")
+    window_ms = float(window_ms if window_ms is not None else os.environ.get("BANK_COMMIT_WINDOW_MS", DEFAULT_WINDOW_MS))
+    return CommitCoordinator(session_factory, window_ms, strict=mode == "strict")
+
+
+def main(argv=None):
+    """Compares strict and group commit throughput with concurrent writers on a throwaway database"""
+    parser = argparse.ArgumentParser(description="Measure group commit throughput.")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent writers")
+    parser.add_argument("--ops", type=int, default=2000, help="transactions per mode")
+    parser.add_argument("--durability", choices=["strict", "balanced", "fast"], default="strict")
+    parser.add_argument("--window-ms", type=float, default=DEFAULT_WINDOW_MS)
+    args = parser.parse_args(argv)
+
+    engine = make_engine(os.path.join(tempfile.mkdtemp(), "commits.db"), args.durability)
+    upgrade(engine)
+    sessions = sessionmaker(bind=engine)
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        session.flush()
+        numbers = [bank.add_account(CHECKING, 1000, session)._account_number for _ in range(args.threads)]
+        bank_id = bank._id
+        session.commit()
+
+    for mode in COMMIT_MODES:
+        commits = make_coordinator(sessions, mode, args.window_ms)
+        per_thread = args.ops // args.threads
+
+        def writer(number):
+            for _ in range(per_thread):
+                commits.run(lambda session: session.get(Bank, bank_id).get_account(number)
+                            .add_transaction(1, session, date.today()))
+        threads = [threading.Thread(target=writer, args=(n,)) for n in numbers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        commits.stop()
+        print(f"{mode:>6}: {per_thread * len(numbers) / elapsed:8.0f} transactions/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
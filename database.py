@@ -0,0 +1,161 @@
+import logging
+import os
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from Accounts import ConcurrentUpdateError
+from migrations import upgrade, check_schema
+
+DEFAULT_PATH = "bank.db"
+
+# PRAGMA synchronous level for each durability profile. With the WAL journal,
+# NORMAL only fsyncs at checkpoints: a power loss can drop the last few commits
+# but never corrupts the database. FULL fsyncs every commit.
+DURABILITY_PROFILES = {
+    "strict": "FULL",
+    "balanced": "NORMAL",
+    "fast": "OFF",
+}
+
+# sessions for the front ends; bound to an engine by init_db
+Session = sessionmaker()
+
+# failures caused by another writer changing the same account first; the work can be run again
+RETRYABLE_ERRORS = (StaleDataError, ConcurrentUpdateError)
+RETRY_ATTEMPTS = 3
+
+
+def make_engine(path=None, durability=None, busy_timeout_ms=5000, cache_size_kb=65536,
+                mmap_size=256 * 1024 * 1024):
+    """Creates an engine for a bank database tuned for SQLite.
+
+    Every new connection is switched to the WAL journal, so readers no longer block
+    the writer, and gets the synchronous level of the durability profile, a busy
+    timeout, a larger page cache and memory-mapped reads. Connections are pooled and
+    may be used from any thread (one at a time), for the GUI's database worker.
+
+    Args:
+        path (str, optional): database file, or ":memory:". Defaults to $BANK_DB or bank.db.
+        durability (str, optional): "strict", "balanced" or "fast". Defaults to $BANK_DB_DURABILITY or "balanced".
+        busy_timeout_ms (int, optional): how long to wait for another connection's lock. Defaults to 5000.
+        cache_size_kb (int, optional): page cache per connection. Defaults to 64 MB.
+        mmap_size (int, optional): bytes of the file to memory-map. Defaults to 256 MB.
+
+    Returns:
+        Engine: the configured engine
+    """
+    path = path or os.environ.get("BANK_DB", DEFAULT_PATH)
+    durability = durability or os.environ.get("BANK_DB_DURABILITY", "balanced")
+    synchronous = DURABILITY_PROFILES[durability]
+
+    if path == ":memory:":
+        # every connection to :memory: is a separate database, so share one
+        engine = sqlalchemy.create_engine("sqlite://", poolclass=StaticPool,
+                                          connect_args={"check_same_thread": False})
+    else:
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}", poolclass=QueuePool,
+                                          pool_size=5, max_overflow=10,
+                                          connect_args={"check_same_thread": False,
+                                                        "timeout": busy_timeout_ms / 1000})
+
+    event.listen(engine, "connect", _pragma_setter(path != ":memory:", synchronous, busy_timeout_ms,
+                                                   cache_size_kb, mmap_size))
+    return engine
+
+
+def make_async_engine(path=None, durability=None, busy_timeout_ms=5000, cache_size_kb=65536,
+                      mmap_size=256 * 1024 * 1024):
+    """Creates an asyncio engine for a bank database, with the same tuning as make_engine.
+
+    Needs the optional aiosqlite package. The schema is not upgraded here; run
+    upgrade() on a make_engine() engine for the same file first.
+
+    Args:
+        path (str, optional): database file. Defaults to $BANK_DB or bank.db. ":memory:" is not supported.
+        durability (str, optional): durability profile. See make_engine.
+
+    Returns:
+        AsyncEngine: the configured engine
+    """
+    # imported here so the front ends do not need the asyncio extras
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    path = path or os.environ.get("BANK_DB", DEFAULT_PATH)
+    durability = durability or os.environ.get("BANK_DB_DURABILITY", "balanced")
+    synchronous = DURABILITY_PROFILES[durability]
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=5, max_overflow=10,
+                                 connect_args={"timeout": busy_timeout_ms / 1000})
+    event.listen(engine.sync_engine, "connect", _pragma_setter(True, synchronous, busy_timeout_ms,
+                                                               cache_size_kb, mmap_size))
+    return engine
+
+
+def _pragma_setter(wal, synchronous, busy_timeout_ms, cache_size_kb, mmap_size):
+    """Returns a "connect" event listener that applies the tuning PRAGMAs to each new connection"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute(f"PRAGMA synchronous = {synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA cache_size = {-int(cache_size_kb)}")
+        cursor.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        cursor.close()
+    return set_pragmas
+
+
+def init_db(path=None, durability=None):
+    """Creates the engine, brings the schema up to date and binds Session to it.
+
+    Args:
+        path (str, optional): database file. See make_engine.
+        durability (str, optional): durability profile. See make_engine.
+
+    Returns:
+        Engine: the engine Session is bound to
+
+    Raises:
+        SchemaVersionError: the database was written by a newer version of the program
+        MigrationError: the database could not be upgraded
+    """
+    engine = make_engine(path, durability)
+    upgrade(engine)
+    check_schema(engine)
+    Session.configure(bind=engine)
+    return engine
+
+
+def commit_with_retry(session, work, attempts=RETRY_ATTEMPTS):
+    """Runs work() and commits, starting over if another session or process wrote to the
+    same accounts first.
+
+    The rollback expires everything in the session, so each attempt re-reads the
+    accounts and checks the balance, limit and date rules against the latest data.
+    Other exceptions are raised unchanged and the caller decides whether to roll back.
+
+    Args:
+        session (Session): session work() uses
+        work (callable): makes the changes; called again for each attempt
+        attempts (int, optional): attempts before giving up. Defaults to 3.
+
+    Returns:
+        the return value of work()
+
+    Raises:
+        ConcurrentUpdateError: every attempt conflicted with another writer
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            session.commit()
+            return result
+        except RETRYABLE_ERRORS as e:
+            session.rollback()
+            if attempt == attempts:
+                raise ConcurrentUpdateError(str(e)) from e
+            logging.info("Write conflict, retrying (attempt %d of %d): %s", attempt, attempts, e)
@@ -0,0 +1,165 @@
+"""Load test for service.py.
+
+Starts the service on a temporary database (or uses --host/--port to reach one that
+is already running), opens some checking accounts and then has concurrent clients
+add transactions and read balances over keep-alive connections. Prints requests per
+second and latency percentiles, and checks the final balances against the
+transactions that were accepted.
+
+    python loadtest.py --clients 50 --requests 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+from service import start_server
+
+
+class Client():
+    """One keep-alive HTTP connection to the service"""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def connect(cls, host, port):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def request(self, method, path, payload=None):
+        """Sends a request and waits for the response.
+
+        Returns:
+            tuple: (HTTP status, decoded JSON body)
+        """
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self._writer.write((f"{method} {path} HTTP/1.1\r\nHost: bank\r\n"
+                            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body)
+        await self._writer.drain()
+        status = int((await self._reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return status, json.loads(await self._reader.readexactly(length))
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+def _percentile(sorted_times, p):
+    return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * p / 100))]
+
+
+async def run(host, port, accounts=20, clients=20, requests=2000, write_ratio=0.8, seed=0):
+    """Runs the load test against a running service.
+
+    Returns:
+        dict: requests, seconds, requests_per_s, p50_ms, p99_ms, errors (by error code) and mismatched balances
+    """
+    rng = random.Random(seed)
+    setup = await Client.connect(host, port)
+    numbers = []
+    expected = {}
+    for _ in range(accounts):
+        status, body = await setup.request("POST", "/accounts", {"type": "checking", "amount": "1000"})
+        if status != 201:
+            raise RuntimeError(f"could not open an account: {body}")
+        numbers.append(body["account_number"])
+        expected[body["account_number"]] = Decimal(body["balance"])
+
+    latencies = []
+    errors = {}
+    remaining = [requests]
+
+    async def client_loop():
+        client = await Client.connect(host, port)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                number = rng.choice(numbers)
+                start = time.perf_counter()
+                if rng.random() < write_ratio:
+                    amount = Decimal(rng.randint(-2000, 2000)) / 100
+                    status, body = await client.request("POST", f"/accounts/{number}/transactions",
+                                                        {"amount": str(amount)})
+                    if status == 201:
+                        expected[number] += amount
+                else:
+                    status, body = await client.request("GET", f"/accounts/{number}")
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    errors[body["error"]] = errors.get(body["error"], 0) + 1
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    status, summary = await setup.request("GET", "/accounts")
+    await setup.close()
+    balances = {s["account_number"]: Decimal(s["balance"]) for s in summary}
+    mismatched = [n for n in numbers if balances.get(n) != expected[n]]
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1e3,
+        "p99_ms": _percentile(latencies, 99) * 1e3,
+        "errors": errors,
+        "mismatched_balances": mismatched,
+    }
+
+
+async def main(args):
+    server = engine = None
+    host, port = args.host, args.port
+    if port is None:
+        # serve a throwaway database from this process
+        path = os.path.join(tempfile.mkdtemp(), "loadtest.db")
+        server, engine = await start_server(path, "127.0.0.1", 0, args.durability)
+        host, port = server.sockets[0].getsockname()[:2]
+    try:
+        result = await run(host, port, args.accounts, args.clients, args.requests, args.write_ratio, args.seed)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            await engine.dispose()
+
+    print(f"{result['requests']} requests in {result['seconds']:.2f} s: {result['requests_per_s']:.0f} req/s, "
+          f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+    for code, count in sorted(result["errors"].items()):
+        print(f"  {code}: {count}")
+    if result["mismatched_balances"]:
+        print(f"Balances do not match the accepted transactions for accounts {result['mismatched_balances']}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load test the bank service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="port of a running service; by default one is started")
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=20, help="concurrent connections")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--write-ratio", type=float, default=0.8, help="share of requests that add a transaction")
+    parser.add_argument("--durability", choices=["strict", "balanced", "fast"])
+    parser.add_argument("--seed", type=int, default=0)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,56 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FILE = "bank.log"
+LOG_FORMAT = '%(asctime)s|%(levelname)s|%(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+# the listener that writes queued records to the log file, once configured
+_listener = None
+
+
+def configure_logging(filename=None, level=None, max_bytes=None, backup_count=None):
+    """Sets up logging for the bank front ends.
+
+    Records are put on an in-memory queue and written to a rotating log file by a
+    background thread, so logging never waits on file I/O. Each setting falls back to
+    an environment variable and then to a default. Calling this again has no effect.
+
+    Args:
+        filename (str, optional): log file. Defaults to $BANK_LOG_FILE or bank.log.
+        level (str or int, optional): lowest level recorded. Defaults to $BANK_LOG_LEVEL or INFO.
+        max_bytes (int, optional): size at which the file is rotated. Defaults to $BANK_LOG_MAX_BYTES or 10 MB.
+        backup_count (int, optional): rotated files kept. Defaults to $BANK_LOG_BACKUPS or 5.
+
+    Returns:
+        QueueListener: the background listener, which is stopped (and flushed) at exit
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    filename = filename or os.environ.get("BANK_LOG_FILE", LOG_FILE)
+    level = level or os.environ.get("BANK_LOG_LEVEL", "INFO")
+    if isinstance(level, str):
+        level = level.upper()
+    if max_bytes is None:
+        max_bytes = int(os.environ.get("BANK_LOG_MAX_BYTES", 10 * 1024 * 1024))
+    if backup_count is None:
+        backup_count = int(os.environ.get("BANK_LOG_BACKUPS", 5))
+
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                        backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
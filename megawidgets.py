@@ -1,25 +1,281 @@
 import tkinter as tk
+import bisect
+from collections import OrderedDict
 
 class TransactionGrid(tk.Frame):
-    """ A custom megawidget that is associated with Transactions in an Account """
-    def __init__(self, parent, transaction_list, **kwargs):
-        super().__init__(parent, **kwargs) 
-        self._transaction_list = transaction_list
+    """ A custom megawidget that is associated with Transactions in an Account
+
+    Only a fixed pool of row labels is ever created. Scrolling rebinds the labels to
+    the transactions in view, which are fetched a block at a time from a paginated
+    source, so the cost of showing an account does not depend on its history size."""
+
+    # number of blocks of transactions kept after they scroll out of view
+    _CACHED_BLOCKS = 4
+
+    def __init__(self, parent, transaction_list=(), rows=15, **kwargs):
+        """
+        Args:
+            parent (Widget): widget to place the grid in
+            transaction_list (sequence or callable, optional): the transactions to show, or a
+                function taking (offset, limit) that returns a page of them. Defaults to none.
+            rows (int, optional): number of rows visible at once. Defaults to 15.
+        """
+        super().__init__(parent, **kwargs)
+        self._rows = rows
+        self._top = 0
+        self._count = 0
+        self._fetch = None
+        self._blocks = OrderedDict()
+
+        #fixed pool of row labels, rebound to whichever transactions are in view
         self._labels = []
+        for _ in range(rows):
+            l = tk.Label(self, width= 27, relief=tk.SUNKEN)
+            l.grid(row=len(self._labels), column=0, padx=5)
+            l.bind('<MouseWheel>', self._on_wheel)
+            l.bind('<Button-4>', self._on_wheel)
+            l.bind('<Button-5>', self._on_wheel)
+            self._labels.append(l)
+        self.bind('<MouseWheel>', self._on_wheel)
+        self.bind('<Button-4>', self._on_wheel)
+        self.bind('<Button-5>', self._on_wheel)
+        self._scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self._on_scroll)
+        self._scrollbar.grid(row=0, column=1, rowspan=rows, sticky="ns")
+
+        self.set_source(transaction_list)
+
+    def set_source(self, transaction_list, count=None):
+        """Shows a new set of transactions, starting from the top.
+
+        Args:
+            transaction_list (sequence or callable): the transactions, or a function taking (offset, limit)
+            count (int, optional): number of transactions the function can return. Required for a function.
+        """
+        if callable(transaction_list):
+            self._fetch = transaction_list
+            self._count = count
+        else:
+            self._fetch = lambda offset, limit: transaction_list[offset:offset + limit]
+            self._count = len(transaction_list)
+        self._top = 0
+        self._blocks.clear()
+        self._render()
+
+    def refresh(self, count=None):
+        """Re-reads the current source, e.g. after a transaction was added, keeping the scroll position if possible"""
+        if count is not None:
+            self._count = count
+        self._blocks.clear()
+        self._scroll_to(self._top)
 
-        #create list of transaction labels
-        for t in self._transaction_list:
-            #red for withdrawal and green for deposit
-            if t.amt >= 0:
-                color = 'green'
+    def scroll_to_end(self):
+        """Scrolls so the most recent transactions are in view"""
+        self._scroll_to(self._count)
+
+    def _scroll_to(self, top):
+        self._top = max(0, min(top, self._count - self._rows))
+        self._render()
+
+    def _on_scroll(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self._scroll_to(round(float(amount) * self._count))
+        elif unit == tk.PAGES:
+            self._scroll_to(self._top + int(amount) * self._rows)
+        else:
+            self._scroll_to(self._top + int(amount))
+
+    def _on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self._scroll_to(self._top - 1)
+        else:
+            self._scroll_to(self._top + 1)
+
+    def _visible(self):
+        """Returns the transactions in view, fetching any blocks that are not cached"""
+        visible = []
+        offset = self._top
+        end = min(self._top + self._rows, self._count)
+        while offset < end:
+            block_num, start = divmod(offset, self._rows)
+            block = self._blocks.get(block_num)
+            if block is None:
+                block = self._fetch(block_num * self._rows, self._rows)
+                self._blocks[block_num] = block
+                if len(self._blocks) > self._CACHED_BLOCKS:
+                    self._blocks.popitem(last=False)
             else:
-                color = 'red'
-            l = tk.Label(parent, text=str(t), width= 27, relief=tk.SUNKEN, fg = color)
-            l.pack( padx=5)
-            self._labels.append(l)
+                self._blocks.move_to_end(block_num)
+            taken = block[start:start + end - offset]
+            if not taken:
+                # the source has fewer transactions than it claimed
+                break
+            visible.extend(taken)
+            offset += len(taken)
+        return visible
+
+    def _render(self):
+        visible = self._visible()
+        for i, l in enumerate(self._labels):
+            if i < len(visible):
+                t = visible[i]
+                #red for withdrawal and green for deposit
+                if t.amt >= 0:
+                    color = 'green'
+                else:
+                    color = 'red'
+                l.configure(text=str(t), fg=color, relief=tk.SUNKEN)
+            else:
+                l.configure(text="", relief=tk.FLAT)
+        if self._count > self._rows:
+            self._scrollbar.set(self._top / self._count, (self._top + self._rows) / self._count)
+        else:
+            self._scrollbar.set(0, 1)
 
     def destroyer(self):
         """Method to destroy the megawidget"""
-        for x in self._labels:
-            x.destroy()
-        
+        self.destroy()
+
+
+class AccountList(tk.Frame):
+    """ A custom megawidget that lists account summaries for selection
+
+    Like TransactionGrid it keeps a fixed pool of buttons bound to the accounts in
+    view. Updates only touch the accounts that changed, and the filter box narrows the
+    list to account numbers starting with what has been typed, using a sorted index."""
+
+    def __init__(self, parent, command, rows=12, **kwargs):
+        """
+        Args:
+            parent (Widget): widget to place the list in
+            command (callable): called with the account number when an account is selected
+            rows (int, optional): number of accounts visible at once. Defaults to 12.
+        """
+        super().__init__(parent, **kwargs)
+        self._command = command
+        self._rows = rows
+        self._top = 0
+        # account number -> AccountSummary
+        self._accounts = {}
+        # account numbers in numeric order, and as strings in text order for prefix search
+        self._numbers = []
+        self._keys = []
+        # the accounts in view are self._view[self._view_start:self._view_end]
+        self._view = self._numbers
+        self._view_start = 0
+        self._view_end = 0
+        self._prefix = ""
+        # text currently bound to each pooled button, so unchanged rows are not reconfigured
+        self._shown = [None] * rows
+
+        #type-ahead filter over account numbers
+        self._filter_text = tk.StringVar()
+        self._filter_text.trace_add("write", lambda *args: self._set_filter(self._filter_text.get()))
+        tk.Label(self, text="Find account #:").grid(row=0, column=0, sticky="w", padx=5)
+        tk.Entry(self, textvariable=self._filter_text, width=12).grid(row=0, column=0, sticky="e", padx=5)
+
+        #fixed pool of account buttons
+        self._selected = tk.IntVar(value=0)
+        self._buttons = []
+        for i in range(rows):
+            b = tk.Radiobutton(self, variable=self._selected, indicator = 0, width = 30,
+                        background = "light blue", activebackground ='white')
+            b.bind('<MouseWheel>', self._on_wheel)
+            b.bind('<Button-4>', self._on_wheel)
+            b.bind('<Button-5>', self._on_wheel)
+            self._buttons.append(b)
+        self._scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self._on_scroll)
+        self._scrollbar.grid(row=1, column=1, rowspan=rows, sticky="ns")
+
+    def set_accounts(self, summaries):
+        """Replaces every account in the list
+
+        Args:
+            summaries (iterable): AccountSummary rows, as returned by Bank.summary
+        """
+        self._accounts = {s.account_number: s for s in summaries}
+        self._numbers = sorted(self._accounts)
+        self._keys = sorted(str(n) for n in self._numbers)
+        self._set_filter(self._prefix, force=True)
+
+    def update_accounts(self, summaries):
+        """Adds or updates some accounts, leaving the rest of the list alone
+
+        Args:
+            summaries (iterable): AccountSummary rows for the accounts that changed
+        """
+        changed = False
+        added = False
+        for s in summaries:
+            old = self._accounts.get(s.account_number)
+            if old == s:
+                continue
+            if old is None:
+                bisect.insort(self._numbers, s.account_number)
+                bisect.insort(self._keys, str(s.account_number))
+                added = True
+            self._accounts[s.account_number] = s
+            changed = True
+        if added:
+            # the view bounds move when rows are inserted
+            self._set_filter(self._prefix, force=True)
+        elif changed:
+            self._render()
+
+    def _set_filter(self, prefix, force=False):
+        prefix = prefix.strip().lstrip("#").lstrip("0")
+        if prefix == self._prefix and not force:
+            return
+        if prefix != self._prefix:
+            self._top = 0
+        self._prefix = prefix
+        if prefix:
+            # every key with the prefix sorts between the prefix and the next possible prefix
+            self._view = self._keys
+            self._view_start = bisect.bisect_left(self._keys, prefix)
+            self._view_end = bisect.bisect_left(self._keys, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        else:
+            self._view = self._numbers
+            self._view_start = 0
+            self._view_end = len(self._numbers)
+        self._scroll_to(self._top)
+
+    def _scroll_to(self, top):
+        self._top = max(0, min(top, self._view_end - self._view_start - self._rows))
+        self._render()
+
+    def _on_scroll(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self._scroll_to(round(float(amount) * (self._view_end - self._view_start)))
+        elif unit == tk.PAGES:
+            self._scroll_to(self._top + int(amount) * self._rows)
+        else:
+            self._scroll_to(self._top + int(amount))
+
+    def _on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self._scroll_to(self._top - 1)
+        else:
+            self._scroll_to(self._top + 1)
+
+    def _render(self):
+        start = self._view_start + self._top
+        for i, b in enumerate(self._buttons):
+            if start + i < self._view_end:
+                num = int(self._view[start + i])
+                shown = (num, str(self._accounts[num]))
+            else:
+                shown = None
+            if shown == self._shown[i]:
+                continue
+            if shown is None:
+                b.grid_remove()
+            else:
+                b.configure(text=shown[1], value=shown[0],
+                            command=lambda num = shown[0]: self._command(num))
+                b.grid(row=i + 1, column=0, sticky="ew", ipady = 5, padx = 5)
+            self._shown[i] = shown
+        total = self._view_end - self._view_start
+        if total > self._rows:
+            self._scrollbar.set(self._top / total, (self._top + self._rows) / total)
+        else:
+            self._scrollbar.set(0, 1)
@@ -0,0 +1,284 @@
+"""Opt-in timing of bank operations and SQL statements.
+
+Nothing is measured until enable() is called: the operations in OPERATIONS are then
+wrapped with timers and SQLAlchemy engine events count every statement. disable()
+puts the original methods back, so the cost when metrics are off is zero.
+"""
+import atexit
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from Accounts import Account, SavingsAccount
+from Bank import Bank
+
+METRICS_FILE = "bank_metrics.json"
+
+# (class, method) pairs timed while metrics are enabled; a subclass override is timed separately
+OPERATIONS = [
+    (Account, "add_transaction"),
+    (Account, "_check_balance"),
+    (Account, "_check_limits"),
+    (SavingsAccount, "_check_limits"),
+    (Account, "_check_date"),
+    (Account, "get_balance"),
+    (Account, "assess_interest_and_fees"),
+    (Account, "get_transactions"),
+    (Bank, "add_account"),
+    (Bank, "get_account"),
+    (Bank, "load_accounts"),
+    (Bank, "summary"),
+    (Bank, "run_month_end"),
+    (Bank, "import_transactions"),
+    (Session, "flush"),
+    (Session, "commit"),
+]
+
+# upper bounds of the latency histogram buckets, in seconds; the last bucket is open-ended
+BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram():
+    """Count, total and bucketed latencies of one operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p-th percentile (0-100)"""
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "p50_s": self.percentile(50),
+            "p95_s": self.percentile(95),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+            "buckets": {f"le_{bound}": n for bound, n in zip(BUCKETS + ["inf"], self.buckets)},
+        }
+
+
+_lock = threading.Lock()
+# operation name -> Histogram
+_operations = {}
+# normalized SQL statement -> Histogram
+_statements = {}
+# (class, method) -> original function, while enabled
+_originals = {}
+# (profiler, coordinator whose thread it runs on or None) for each profiled thread, while capturing
+_profilers = None
+_enabled_at = None
+
+
+def is_enabled():
+    return _enabled_at is not None
+
+
+def _record(table, name, seconds):
+    with _lock:
+        h = table.get(name)
+        if h is None:
+            h = table[name] = Histogram()
+        h.record(seconds)
+
+
+def _timed(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _record(_operations, name, time.perf_counter() - start)
+    return wrapper
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("metrics_start")
+    if starts:
+        # the same statement text with different parameters counts as one statement
+        _record(_statements, " ".join(statement.split()), time.perf_counter() - starts.pop())
+
+
+def enable():
+    """Starts timing the operations in OPERATIONS and every SQL statement. Does nothing if already enabled."""
+    global _enabled_at
+    if is_enabled():
+        return
+    for cls, name in OPERATIONS:
+        fn = cls.__dict__.get(name)
+        if fn is not None:
+            _originals[(cls, name)] = fn
+            setattr(cls, name, _timed(f"{cls.__name__}.{name}", fn))
+    event.listen(Engine, "before_cursor_execute", _before_execute)
+    event.listen(Engine, "after_cursor_execute", _after_execute)
+    _enabled_at = time.time()
+    logging.info("Metrics enabled")
+
+
+def disable():
+    """Stops timing and restores the original methods. The numbers collected so far are kept."""
+    global _enabled_at
+    if not is_enabled():
+        return
+    for (cls, name), fn in _originals.items():
+        setattr(cls, name, fn)
+    _originals.clear()
+    event.remove(Engine, "before_cursor_execute", _before_execute)
+    event.remove(Engine, "after_cursor_execute", _after_execute)
+    _enabled_at = None
+    logging.info("Metrics disabled")
+
+
+def reset():
+    """Forgets everything recorded so far"""
+    with _lock:
+        _operations.clear()
+        _statements.clear()
+
+
+def snapshot():
+    """Returns everything recorded so far as JSON-ready data"""
+    with _lock:
+        operations = {name: h.to_dict() for name, h in _operations.items()}
+        statements = {sql: h.to_dict() for sql, h in _statements.items()}
+    return {
+        "enabled_since": _enabled_at,
+        "operations": operations,
+        "sql": {
+            "count": sum(s["count"] for s in statements.values()),
+            "total_s": sum(s["total_s"] for s in statements.values()),
+            "statements": statements,
+        },
+    }
+
+
+def dump(path=None):
+    """Writes snapshot() to a JSON file.
+
+    Args:
+        path (str, optional): file to write. Defaults to $BANK_METRICS_FILE or bank_metrics.json.
+
+    Returns:
+        str: the file written
+    """
+    path = path or os.environ.get("BANK_METRICS_FILE", METRICS_FILE)
+    with open(path, "w") as f:
+        json.dump(snapshot(), f, indent=2)
+    return path
+
+
+def report(top=10):
+    """Formats the operations and the slowest SQL statements as a text table"""
+    data = snapshot()
+    lines = [f"{'operation':<36}{'count':>8}{'total ms':>11}{'mean ms':>10}{'p95 ms':>9}{'max ms':>9}"]
+    for name, h in sorted(data["operations"].items(), key=lambda item: -item[1]["total_s"]):
+        lines.append(f"{name:<36}{h['count']:>8}{h['total_s'] * 1e3:>11.2f}{h['mean_s'] * 1e3:>10.3f}"
+                     f"{h['p95_s'] * 1e3:>9.3f}{h['max_s'] * 1e3:>9.3f}")
+    sql = data["sql"]
+    lines.append(f"\nSQL: {sql['count']} statement(s), {sql['total_s'] * 1e3:.2f} ms")
+    slowest = sorted(sql["statements"].items(), key=lambda item: -item[1]["total_s"])[:top]
+    for statement, h in slowest:
+        lines.append(f"{h['count']:>8}{h['total_s'] * 1e3:>11.2f} ms  {statement[:80]}")
+    return "\n".join(lines)
+
+
+def start_profile(commits=None):
+    """Starts a cProfile capture of the calling thread and, if a commit coordinator is
+    given, of its thread, where the front ends' changes run. Returns False if one is
+    already running.
+
+    Args:
+        commits (CommitCoordinator, optional): coordinator whose jobs to profile too. Defaults to None.
+    """
+    global _profilers
+    if _profilers is not None:
+        return False
+    profiler = cProfile.Profile()
+    profiler.enable()
+    _profilers = [(profiler, None)]
+    if commits is not None:
+        worker = cProfile.Profile()
+        try:
+            # a profiler only sees the thread that enables it, so the coordinator enables its own
+            commits.run(lambda session: worker.enable())
+        except ValueError:
+            # from Python 3.12 a profiler sees every thread, and only one can be active
+            pass
+        else:
+            _profilers.append((worker, commits))
+    return True
+
+
+def stop_profile(path=None, top=25):
+    """Ends the cProfile capture, combining the profiled threads.
+
+    Args:
+        path (str, optional): file to save the raw stats to, for pstats or snakeviz
+        top (int, optional): number of functions in the returned summary. Defaults to 25.
+
+    Returns:
+        str: the functions with the most cumulative time, or None if no capture was running
+    """
+    global _profilers
+    if _profilers is None:
+        return None
+    profilers, _profilers = _profilers, None
+    for profiler, commits in profilers:
+        if commits is None:
+            profiler.disable()
+        else:
+            commits.run(lambda session, profiler=profiler: profiler.disable())
+    out = io.StringIO()
+    stats = pstats.Stats(*(profiler for profiler, _ in profilers), stream=out)
+    if path:
+        stats.dump_stats(path)
+    stats.sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+def is_profiling():
+    return _profilers is not None
+
+
+def configure_metrics():
+    """Enables metrics if $BANK_METRICS is set (to anything but 0), and dumps them to the metrics file at exit"""
+    if os.environ.get("BANK_METRICS", "0") in ("", "0"):
+        return False
+    enable()
+    atexit.register(dump)
+    return True
@@ -0,0 +1,195 @@
+import logging
+import shutil
+import sys
+
+import sqlalchemy
+
+from Transactions import Base
+# imported so every table is registered with Base.metadata
+from Bank import Bank
+from Snapshots import BalanceSnapshot
+from money import ScaledDecimal
+
+
+class SchemaVersionError(Exception):
+    def __init__(self, found, expected):
+        super().__init__(f"bank.db schema version is {found}, this program needs version {expected}")
+        self.found = found
+        self.expected = expected
+
+
+class MigrationError(Exception):
+    def __init__(self, version, cause):
+        super().__init__(f"Could not upgrade bank.db to schema version {version} "
+                         f"({cause.__class__.__name__}: {cause}); the file was left at version {version - 1}")
+        self.version = version
+        self.cause = cause
+
+
+def _rebuild_money_columns(conn):
+    """Version 1: stores amounts as integer cents and rates as integer millionths.
+
+    Every table is rebuilt from the current schema: float amounts and rates are
+    converted (rounded half up), columns added since the file was created start out
+    empty, and other columns are copied unchanged. Databases from before the running
+    balance and the account number counter get both filled in from their rows, and
+    account numbers that were handed out twice are renumbered so they can be unique."""
+    existing = set(sqlalchemy.inspect(conn).get_table_names())
+    if "account" in existing:
+        _renumber_duplicate_accounts(conn)
+    for table in Base.metadata.sorted_tables:
+        if table.name in existing:
+            _rebuild_table(conn, table)
+        else:
+            table.create(conn)
+    conn.exec_driver_sql('UPDATE account SET _balance = (SELECT coalesce(sum(_amt), 0) FROM "transaction" '
+                         'WHERE "transaction"._account_id = account._id) WHERE _balance IS NULL')
+    conn.exec_driver_sql("UPDATE bank SET _last_account_number = max(coalesce(_last_account_number, 0), "
+                         "(SELECT coalesce(max(_account_number), 0) FROM account WHERE account._bank_id = bank._id))")
+
+
+def _renumber_duplicate_accounts(conn):
+    """Gives every account but the first (by id) with a shared account number a new number
+    above the highest in use. Processes that allocated numbers before the counter existed
+    could hand out the same one twice."""
+    duplicates = conn.exec_driver_sql(
+        "SELECT a._id, a._account_number FROM account a WHERE EXISTS (SELECT 1 FROM account b "
+        "WHERE b._account_number = a._account_number AND b._id < a._id) ORDER BY a._id").fetchall()
+    if not duplicates:
+        return
+    highest = conn.exec_driver_sql("SELECT max(_account_number) FROM account").scalar()
+    for new_number, (account_id, old_number) in enumerate(duplicates, highest + 1):
+        conn.exec_driver_sql("UPDATE account SET _account_number = ? WHERE _id = ?", (new_number, account_id))
+        logging.warning("Account number %09d was used by more than one account; account %d is now #%09d",
+                        old_number, account_id, new_number)
+
+
+def _create_indexes(conn):
+    """Version 2: indexes for loading accounts and transactions and for date ranges"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _add_account_versions(conn):
+    """Version 3: a version counter on account for optimistic locking. Databases upgraded
+    from version 0 already have the column, since version 1 rebuilt the table."""
+    columns = {c["name"] for c in sqlalchemy.inspect(conn).get_columns("account")}
+    if "_version" not in columns:
+        conn.exec_driver_sql("ALTER TABLE account ADD COLUMN _version INTEGER NOT NULL DEFAULT 0")
+
+
+def _create_snapshots(conn):
+    """Version 4: the balance_snapshot table and its indexes. It starts out empty, which
+    is correct but slower for long histories; Bank.rebuild_snapshots fills it in."""
+    BalanceSnapshot.__table__.create(conn, checkfirst=True)
+    _create_indexes(conn)
+
+
+# each step upgrades a database by one version; the version is kept in PRAGMA user_version
+MIGRATIONS = [
+    _rebuild_money_columns,
+    _create_indexes,
+    _add_account_versions,
+    _create_snapshots,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def upgrade(engine):
+    """Brings a database up to the current schema, creating it if it is empty.
+
+    Each migration runs in its own SQLite transaction together with the version bump,
+    so an interrupted upgrade resumes from the last completed step.
+
+    Args:
+        engine (Engine): engine for the database to upgrade
+
+    Returns:
+        int: the version the database was at before the upgrade
+
+    Raises:
+        SchemaVersionError: the database was written by a newer version of the program
+        MigrationError: a step failed; the database is left at the last completed version
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        found = get_schema_version(conn)
+        if found > SCHEMA_VERSION:
+            raise SchemaVersionError(found, SCHEMA_VERSION)
+        if not sqlalchemy.inspect(conn).get_table_names():
+            conn.exec_driver_sql("BEGIN")
+            Base.metadata.create_all(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.exec_driver_sql("COMMIT")
+            return found
+        # keep references from other tables pointing at the table names while they are rebuilt
+        conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+        for version in range(found, SCHEMA_VERSION):
+            conn.exec_driver_sql("BEGIN")
+            try:
+                MIGRATIONS[version](conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {version + 1}")
+            except Exception as e:
+                conn.exec_driver_sql("ROLLBACK")
+                raise MigrationError(version + 1, e) from e
+            conn.exec_driver_sql("COMMIT")
+            logging.info("Upgraded bank.db schema to version %d", version + 1)
+        conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+    return found
+
+
+def check_schema(engine):
+    """Fails loudly if the database is not at the schema version this program expects
+
+    Raises:
+        SchemaVersionError: the database needs upgrade() or is newer than the program
+    """
+    with engine.connect() as conn:
+        found = get_schema_version(conn)
+    if found != SCHEMA_VERSION:
+        raise SchemaVersionError(found, SCHEMA_VERSION)
+
+
+def _rebuild_table(conn, table):
+    """Recreates a table from its current definition and copies the old rows into it"""
+    old_name = f"_old_{table.name}"
+    declared = {row[1]: row[2].upper() for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+    # indexes keep their names when a table is renamed, so drop them before the new table recreates them
+    indexes = conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                   "AND tbl_name = ? AND sql IS NOT NULL", (table.name,)).fetchall()
+    for (index_name,) in indexes:
+        conn.exec_driver_sql(f'DROP INDEX "{index_name}"')
+    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" RENAME TO "{old_name}"')
+    table.create(conn)
+
+    columns = []
+    values = []
+    for column in table.columns:
+        if column.name not in declared:
+            continue
+        columns.append(f'"{column.name}"')
+        if isinstance(column.type, ScaledDecimal) and declared[column.name] != "BIGINT":
+            values.append(f'CAST(ROUND("{column.name}" * {10 ** column.type.places}) AS INTEGER)')
+        else:
+            values.append(f'"{column.name}"')
+    conn.exec_driver_sql(f'INSERT INTO "{table.name}" ({", ".join(columns)}) '
+                         f'SELECT {", ".join(values)} FROM "{old_name}"')
+    conn.exec_driver_sql(f'DROP TABLE "{old_name}"')
+
+
+if __name__ == "__main__":
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "bank.db"
+    shutil.copyfile(path, path + ".bak")
+    try:
+        found = upgrade(sqlalchemy.create_engine(f"sqlite:///{path}"))
+    except (SchemaVersionError, MigrationError) as e:
+        sys.exit(str(e))
+    if found < SCHEMA_VERSION:
+        print(f"Upgraded {path} from schema version {found} to {SCHEMA_VERSION} (backup saved as {path}.bak).")
+    else:
+        print(f"{path} is already at schema version {SCHEMA_VERSION}.")
@@ -0,0 +1,89 @@
+from decimal import Context, Decimal, ROUND_HALF_UP, InvalidOperation, DivisionByZero, Overflow, setcontext
+from sqlalchemy.types import TypeDecorator, BigInteger
+
+# the bank's Decimal context: half-up rounding, and enough digits (28) that any 64-bit column
+# value fits and sums and products of amounts and rates are exact until they are rounded to
+# cents. Conversions pass it explicitly; threads that run domain code install it with use_context()
+CONTEXT = Context(prec=28, rounding=ROUND_HALF_UP, traps=[InvalidOperation, DivisionByZero, Overflow])
+
+
+class InvalidAmountError(ValueError):
+    """An amount that is not a finite number or is too large to store"""
+    def __init__(self, value):
+        super().__init__(f"{value} is not a valid amount")
+        self.value = value
+
+
+def use_context():
+    "Makes CONTEXT the calling thread's Decimal context, since every thread starts with the default one"
+    setcontext(CONTEXT.copy())
+
+
+class ScaledDecimal(TypeDecorator):
+    """Column type that stores a Decimal as a 64-bit integer count of 10**-places units.
+
+    Domain code only ever sees Decimal values, while the database holds exact integers,
+    so SUM() and comparisons in SQL are exact. Subclasses set the number of places."""
+
+    impl = BigInteger
+    cache_ok = True
+    places = 2
+    # the largest magnitude the 64-bit column holds, in 10**-places units
+    max_units = 2 ** 63 - 1
+
+    def quantize(self, value):
+        """Rounds a value to the column's places (half up).
+
+        Raises:
+            InvalidAmountError: the value is not a finite number or does not fit in the column
+        """
+        try:
+            rounded = to_decimal(value).quantize(Decimal(1).scaleb(-self.places, CONTEXT), rounding=ROUND_HALF_UP,
+                                                 context=CONTEXT)
+        except InvalidOperation:
+            # infinities, text that is not a number, and more digits than CONTEXT holds
+            raise InvalidAmountError(value) from None
+        if not rounded.is_finite() or rounded.scaleb(self.places, CONTEXT).copy_abs() > self.max_units:
+            raise InvalidAmountError(value)
+        return rounded
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(self.quantize(value).scaleb(self.places, CONTEXT))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # int() also accepts REAL values left over from databases that were not migrated
+        return Decimal(int(value)).scaleb(-self.places, CONTEXT)
+
+
+class Money(ScaledDecimal):
+    """Dollar amounts, stored as integer cents"""
+    cache_ok = True
+    places = 2
+
+
+class Rate(ScaledDecimal):
+    """Interest rates, stored as integer millionths"""
+    cache_ok = True
+    places = 6
+
+
+def to_decimal(value):
+    "Converts an int, float, str or Decimal to Decimal without binary float artifacts"
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+def to_money(value):
+    """Rounds an amount to whole cents (half up), the precision amounts are stored with
+
+    Raises:
+        InvalidAmountError: the amount is not a finite number or is too large to store in cents
+    """
+    return Money().quantize(value)
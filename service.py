@@ -0,0 +1,389 @@
+"""A local HTTP/JSON service over the bank, for many concurrent clients.
+
+Runs on asyncio with an async SQLAlchemy engine (needs the optional aiosqlite
+package). Each request gets its own session and runs the usual Bank and Account
+methods through run_sync, so the rules are the same as in the GUI and CLI.
+
+    python service.py --port 8080
+
+Endpoints (amounts are decimal strings, dates YYYY-MM-DD):
+
+    GET  /accounts                              summary of every account
+    POST /accounts                              {"type": "savings", "amount": "100"}
+    GET  /accounts/<number>                     one account's summary
+    GET  /accounts/<number>/transactions        ?offset=&limit=&start=&end=
+    POST /accounts/<number>/transactions        {"amount": "-20", "date": "2024-01-31"}
+    POST /month-end                             {"month": "2024-01"}
+
+Failures return {"error": <exception name>, "message": ...}, e.g. OverdrawError.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlsplit, parse_qsl
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from Bank import Bank, UnknownAccountError
+from Accounts import OverdrawError, TransactionLimitError, TransactionSequenceError, ConcurrentUpdateError
+from database import make_engine, make_async_engine, RETRYABLE_ERRORS, RETRY_ATTEMPTS
+from logconfig import configure_logging
+from migrations import upgrade, SchemaVersionError, MigrationError
+from money import InvalidAmountError, to_money
+
+MAX_BODY = 1024 * 1024
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class NotFound(LookupError):
+    pass
+
+
+# HTTP status for each exception a request can fail with; the exception's name is the error code
+ERROR_STATUS = {
+    BadRequest: 400,
+    InvalidAmountError: 400,
+    NotFound: 404,
+    UnknownAccountError: 404,
+    OverdrawError: 409,
+    TransactionLimitError: 409,
+    TransactionSequenceError: 409,
+    ConcurrentUpdateError: 409,
+}
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 409: "Conflict",
+           500: "Internal Server Error"}
+
+
+def _summary_json(s):
+    return {"type": s.type, "account_number": s.account_number, "balance": str(s.balance)}
+
+
+def _transaction_json(t):
+    return {"date": t.date.isoformat(), "amount": str(t.amt), "exempt": bool(t.is_exempt())}
+
+
+def _amount(body):
+    try:
+        amount = Decimal(str(body["amount"]))
+    except (KeyError, InvalidOperation):
+        raise BadRequest("amount must be a decimal number")
+    # NaN, infinity and amounts too large to store in cents
+    return to_money(amount)
+
+
+def _date(text, fmt="%Y-%m-%d"):
+    try:
+        return datetime.strptime(text, fmt).date()
+    except (TypeError, ValueError):
+        raise BadRequest(f"dates must be in the format {fmt.replace('%Y', 'YYYY').replace('%m', 'MM').replace('%d', 'DD')}")
+
+
+def _int(text, name):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be a whole number")
+
+
+class BankService():
+    """Handles the service's requests against one bank.
+
+    Writes to an account are serialized with a lock per account, so requests for
+    unrelated accounts run concurrently. Month-end takes every account's lock.
+    SQLite has a single writer, so the commits themselves also take turns on a
+    process-wide lock instead of sleeping in SQLite's busy handler."""
+
+    def __init__(self, engine, bank_id):
+        """
+        Args:
+            engine (AsyncEngine): engine for the bank database
+            bank_id (int): primary key of the bank to serve
+        """
+        self._sessions = async_sessionmaker(engine, expire_on_commit=False)
+        self._bank_id = bank_id
+        # account number -> asyncio.Lock
+        self._locks = {}
+        self._write_lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, engine):
+        """Creates the service for the first bank in the database, creating the bank if there is none"""
+        async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+            bank_id = (await session.execute(select(Bank._id).order_by(Bank._id).limit(1))).scalar()
+            if bank_id is None:
+                bank = Bank()
+                session.add(bank)
+                await session.commit()
+                bank_id = bank._id
+        return cls(engine, bank_id)
+
+    def _lock(self, account_number):
+        lock = self._locks.get(account_number)
+        if lock is None:
+            lock = self._locks[account_number] = asyncio.Lock()
+        return lock
+
+    async def _run(self, fn, commit=False, writes=False):
+        """Runs fn(session, bank) with the synchronous ORM API in a new session.
+
+        Args:
+            commit (bool, optional): commit after fn. Defaults to False.
+            writes (bool, optional): fn itself writes to the database, so it runs under the write lock too.
+                Otherwise only the commit does. Defaults to False.
+        """
+        def work(sync_session):
+            return fn(sync_session, sync_session.get(Bank, self._bank_id))
+        # the account locks only cover this process; another process writing the same
+        # account makes the commit fail the version check, and the work is run again
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            async with self._sessions() as session:
+                try:
+                    if writes:
+                        async with self._write_lock:
+                            result = await session.run_sync(work)
+                            await session.commit()
+                        return result
+                    result = await session.run_sync(work)
+                    if commit:
+                        async with self._write_lock:
+                            await session.commit()
+                    return result
+                except RETRYABLE_ERRORS as e:
+                    await session.rollback()
+                    if attempt == RETRY_ATTEMPTS:
+                        raise ConcurrentUpdateError(str(e)) from e
+
+    async def handle(self, method, path, query, body):
+        """Routes one request.
+
+        Returns:
+            tuple: (HTTP status, JSON-ready response)
+        """
+        parts = [p for p in path.split("/") if p]
+        if parts == ["accounts"] and method == "GET":
+            return 200, await self.summary()
+        if parts == ["accounts"] and method == "POST":
+            return 201, await self.open_account(body)
+        if len(parts) == 2 and parts[0] == "accounts" and method == "GET":
+            return 200, await self.get_account(_int(parts[1], "account number"))
+        if len(parts) == 3 and parts[0] == "accounts" and parts[2] == "transactions":
+            number = _int(parts[1], "account number")
+            if method == "GET":
+                return 200, await self.list_transactions(number, query)
+            if method == "POST":
+                return 201, await self.add_transaction(number, body)
+        if parts == ["month-end"] and method == "POST":
+            return 200, await self.month_end(body)
+        raise NotFound(f"No route for {method} {path}")
+
+    async def summary(self):
+        return await self._run(lambda session, bank: [_summary_json(s) for s in bank.summary(session)])
+
+    async def get_account(self, number):
+        def work(session, bank):
+            rows = bank.summary(session, [number])
+            if not rows:
+                raise UnknownAccountError(number)
+            return _summary_json(rows[0])
+        return await self._run(work)
+
+    async def open_account(self, body):
+        acct_type = str(body.get("type", "")).lower()
+        amount = _amount(body)
+
+        def work(session, bank):
+            a = bank.add_account(acct_type, amount, session)
+            if a is None:
+                raise BadRequest("type must be savings or checking")
+            return {"type": a._type, "account_number": a._account_number, "balance": str(a.get_balance())}
+        # a new number is allocated in the same database transaction, so no account lock is needed
+        return await self._run(work, writes=True)
+
+    async def add_transaction(self, number, body):
+        if "exempt" in body:
+            # exempt transactions skip every rule; only /month-end adds them, as interest and fees
+            raise BadRequest("exempt transactions are only added by /month-end")
+        amount = _amount(body)
+        when = _date(body["date"]) if body.get("date") else None
+
+        def work(session, bank):
+            a = bank.get_account(number)
+            if a is None:
+                raise UnknownAccountError(number)
+            a.add_transaction(amount, session, when)
+            return {"account_number": number, "balance": str(a.get_balance())}
+        # the checks read the account before the insert, so two writers must not interleave
+        async with self._lock(number):
+            return await self._run(work, commit=True)
+
+    async def list_transactions(self, number, query):
+        offset = _int(query.get("offset", 0), "offset")
+        limit = _int(query["limit"], "limit") if "limit" in query else None
+        start = _date(query["start"]) if "start" in query else None
+        end = _date(query["end"]) if "end" in query else None
+
+        def work(session, bank):
+            a = bank.get_account(number)
+            if a is None:
+                raise UnknownAccountError(number)
+            return [_transaction_json(t) for t in a.get_transactions(offset, limit, start, end)]
+        return await self._run(work)
+
+    async def month_end(self, body):
+        month = _date(body.get("month"), "%Y-%m")
+
+        def work(session, bank):
+            results = []
+            for r in bank.run_month_end(month, session):
+                result = {"account_number": r.account_number}
+                if r.error is not None:
+                    result.update(error=r.error.__class__.__name__, latest_date=r.error.latest_date.isoformat())
+                else:
+                    result.update(interest=str(r.interest), fee=None if r.fee is None else str(r.fee))
+                results.append(result)
+            return results
+        numbers = await self._run(lambda session, bank: [s.account_number for s in bank.summary(session)])
+        # locks are always taken in account number order, so this cannot deadlock with another month-end
+        locks = [self._lock(n) for n in sorted(numbers)]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            return await self._run(work, writes=True)
+        finally:
+            for lock in locks:
+                lock.release()
+
+
+async def _read_request(reader):
+    """Reads one HTTP/1.1 request.
+
+    Returns:
+        tuple: (method, target, headers, body), or None if the client closed the connection
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise BadRequest("malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = _int(headers.get("content-length", 0), "Content-Length")
+    if length > MAX_BODY:
+        raise BadRequest("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+
+def _response(status, payload, keep_alive):
+    body = json.dumps(payload).encode()
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode() + body
+
+
+def _error(e):
+    for cls, status in ERROR_STATUS.items():
+        if isinstance(e, cls):
+            payload = {"error": e.__class__.__name__, "message": str(e)}
+            if isinstance(e, TransactionSequenceError):
+                payload["latest_date"] = e.latest_date.isoformat()
+            return status, payload
+    logging.error("%s: %r", e.__class__.__name__, str(e))
+    return 500, {"error": "InternalError", "message": "Something unexpected happened"}
+
+
+def make_handler(service):
+    """Returns an asyncio.start_server callback that serves requests on each connection until it closes"""
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                keep_alive = True
+                try:
+                    request = await _read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, raw = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    url = urlsplit(target)
+                    try:
+                        body = json.loads(raw) if raw else {}
+                    except ValueError:
+                        raise BadRequest("body must be JSON")
+                    if not isinstance(body, dict):
+                        raise BadRequest("body must be a JSON object")
+                    status, payload = await service.handle(method, url.path, dict(parse_qsl(url.query)), body)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    status, payload = _error(e)
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    return handle_connection
+
+
+async def start_server(path=None, host="127.0.0.1", port=8080, durability=None):
+    """Upgrades the database schema and starts serving.
+
+    Returns:
+        tuple: (asyncio Server, AsyncEngine); close the server and dispose of the engine when done
+    """
+    sync_engine = make_engine(path, durability)
+    upgrade(sync_engine)
+    sync_engine.dispose()
+    engine = make_async_engine(path, durability)
+    service = await BankService.open(engine)
+    server = await asyncio.start_server(make_handler(service), host, port)
+    logging.info("Serving on %s:%d", host, port)
+    return server, engine
+
+
+async def serve(path=None, host="127.0.0.1", port=8080, durability=None):
+    server, engine = await start_server(path, host, port, durability)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve the bank over HTTP/JSON.")
+    parser.add_argument("--db", help="database file (default $BANK_DB or bank.db)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--durability", choices=["strict", "balanced", "fast"])
+    args = parser.parse_args()
+
+    configure_logging()
+    try:
+        asyncio.run(serve(args.db, args.host, args.port, args.durability))
+    except (SchemaVersionError, MigrationError) as e:
+        logging.error("%s: %s", e.__class__.__name__, e)
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,175 @@
+"""Startup time for the CLI and GUI.
+
+Builds a seeded synthetic bank of the requested size (or uses an existing database),
+then measures how long the front-end modules take to import (python -X importtime)
+and how long a fresh process takes to show the CLI's first menu and the GUI's first
+window and account list. The exit status is 1 if a start takes longer than the
+budget. For example:
+
+    python startup.py --accounts 100 --transactions 10000 --budget-ms 1500
+
+The GUI is skipped where it cannot open a window (no display).
+"""
+import argparse
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks import generate_bank
+from database import make_engine
+from migrations import upgrade
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FRONT_ENDS = ("BankCLI", "bankGUI")
+
+
+def build_database(path, num_accounts, num_transactions, seed=0):
+    """Creates a bank database file for the front ends to start against"""
+    engine = make_engine(path)
+    upgrade(engine)
+    with sessionmaker(bind=engine)() as session:
+        generate_bank(session, num_accounts, num_transactions, seed)
+        session.commit()
+    engine.dispose()
+
+
+def import_times(module, top=5):
+    """Imports a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        tuple: total seconds, and the (seconds, name) of the slowest modules it imports directly
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    total = 0
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented two spaces per level under the module that imported them
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == module:
+            total = int(cumulative) / 1e6
+        elif depth == 1:
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return total, sorted(imports, reverse=True)[:top]
+
+
+def time_to_markers(args, markers, env, stdin=None, timeout=60):
+    """Starts a process and times how long it takes to print each marker.
+
+    Returns:
+        dict: seconds from launch to each marker seen; a missing marker was never printed
+    """
+    lines = queue.Queue()
+    start = time.perf_counter()
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               env=env, cwd=env["BANK_STARTUP_DIR"], text=True)
+
+    def read():
+        for line in process.stdout:
+            lines.put((time.perf_counter() - start, line))
+        lines.put(None)
+    threading.Thread(target=read, daemon=True).start()
+
+    found = {}
+    deadline = start + timeout
+    try:
+        while len(found) < len(markers):
+            item = lines.get(timeout=max(0, deadline - time.perf_counter()))
+            if item is None:
+                break
+            elapsed, line = item
+            for marker in markers:
+                if marker in line and marker not in found:
+                    found[marker] = elapsed
+        if stdin is not None and process.poll() is None:
+            process.stdin.write(stdin)
+            process.stdin.flush()
+    except queue.Empty:
+        pass
+    finally:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return found
+
+
+def measure(path, repeat=3):
+    """Times the front ends starting against a database, keeping the median of repeat runs.
+
+    Returns:
+        dict: seconds to the CLI menu, the GUI window and the GUI account list (None if not shown)
+    """
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ, BANK_DB=os.path.abspath(path), BANK_STARTUP_PROBE="1", BANK_STARTUP_DIR=workdir)
+    runs = {"cli_menu": [], "gui_window": [], "gui_accounts": []}
+    try:
+        for _ in range(repeat):
+            cli = time_to_markers([sys.executable, os.path.join(HERE, "BankCLI.py")], ["Enter command"], env, "7\n")
+            runs["cli_menu"].append(cli.get("Enter command"))
+            gui = time_to_markers([sys.executable, os.path.join(HERE, "bankGUI.py")],
+                                  ["first frame", "accounts shown"], env)
+            runs["gui_window"].append(gui.get("first frame"))
+            runs["gui_accounts"].append(gui.get("accounts shown"))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {name: None if None in times else sorted(times)[len(times) // 2] for name, times in runs.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the CLI and GUI startup.")
+    parser.add_argument("--db", help="existing database to start against (default: build one)")
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--transactions", type=int, default=1000, help="per account")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="starts per front end; the median is kept")
+    parser.add_argument("--budget-ms", type=float, default=1500,
+                        help="longest acceptable time to the first menu or window (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    path = args.db
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "startup.db")
+        print(f"Building {args.accounts}x{args.transactions} bank...")
+        build_database(path, args.accounts, args.transactions, args.seed)
+
+    for module in FRONT_ENDS:
+        try:
+            total, slowest = import_times(module)
+        except RuntimeError as e:
+            print(f"import {module}: failed ({e})")
+            continue
+        print(f"import {module}: {total * 1e3:.0f} ms; slowest " +
+              ", ".join(f"{name} {seconds * 1e3:.0f} ms" for seconds, name in slowest))
+
+    times = measure(path, args.repeat)
+    over = []
+    for name, label in [("cli_menu", "CLI first menu"), ("gui_window", "GUI first window"),
+                        ("gui_accounts", "GUI accounts shown")]:
+        if times[name] is None:
+            print(f"  {label:<22} not shown (no display?)")
+            continue
+        print(f"  {label:<22} {times[name] * 1e3:8.0f} ms")
+        if name != "gui_accounts" and times[name] * 1e3 > args.budget_ms:
+            over.append(label)
+    if over:
+        print(f"Over the {args.budget_ms:.0f} ms budget: {', '.join(over)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""Statements for every account over a date range.
+
+Each account's transactions are streamed from the database in batches of plain rows
+(no ORM objects) and written straight to CSV and/or plain-text files with opening and
+closing balances, so memory use depends on the batch size and not on the length of
+the history. Accounts can be spread over a pool of worker processes, each with its
+own connection, since SQLite in WAL mode serves many readers at once. For example:
+
+    python statements.py 2026-09 --out statements --workers 4
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import sessionmaker
+
+from Transactions import Transaction
+from Accounts import Account
+from database import make_engine
+
+FORMATS = ("csv", "txt")
+BATCH_SIZE = 1000
+
+# what was written for one account
+StatementResult = namedtuple("StatementResult", ["account_number", "opening", "closing", "count", "paths"])
+
+# the worker process's sessions, created by _init_worker
+_worker_sessions = None
+
+
+def month_range(month):
+    """Returns the first and last day of the month containing a date"""
+    first = month.replace(day=1)
+    return first, date(first.year + first.month // 12, first.month % 12 + 1, 1) - timedelta(1)
+
+
+def write_statements(session, account, start, end, out_dir, formats=FORMATS, batch_size=BATCH_SIZE):
+    """Writes one account's statements for a date range.
+
+    The opening balance is summed in SQL and the transactions in the range are
+    fetched batch_size rows at a time, each written out before the next batch is read.
+
+    Args:
+        session (Session): session to read with
+        account (tuple): the account's (_id, _type, _account_number)
+        start (Date): first day of the statement
+        end (Date): last day of the statement
+        out_dir (str): directory for the files, which must exist
+        formats (iterable, optional): "csv" and/or "txt". Defaults to both.
+        batch_size (int, optional): rows fetched per round trip. Defaults to 1000.
+
+    Returns:
+        StatementResult: the balances, number of transactions and the files written
+    """
+    account_id, account_type, number = account
+    opening = session.scalar(select(func.coalesce(func.sum(Transaction._amt), 0))
+                             .where(Transaction._account_id == account_id, Transaction._date < start))
+    rows = session.execute(select(Transaction._date, Transaction._amt, Transaction._exempt)
+                           .where(Transaction._account_id == account_id,
+                                  Transaction._date >= start, Transaction._date <= end)
+                           .order_by(Transaction._date, Transaction._id)
+                           .execution_options(yield_per=batch_size))
+
+    title = f"{account_type.capitalize()}#{number:09}"
+    paths = [os.path.join(out_dir, f"{number:09}_{start}_{end}.{f}") for f in formats]
+    files = [open(p, "w", newline="") for p in paths]
+    try:
+        writers = []
+        for f, out in zip(formats, files):
+            if f == "csv":
+                writer = csv.writer(out)
+                writer.writerow(["date", "description", "amount", "balance"])
+                writer.writerow([start, "opening balance", "", opening])
+                writers.append(lambda d, desc, amt, bal, writer=writer: writer.writerow([d, desc, amt, bal]))
+            else:
+                out.write(f"{title} statement, {start} to {end}\n\n")
+                out.write(f"{'':10}  {'opening balance':<16}{'':>14}  ${opening:>14,.2f}\n")
+                writers.append(lambda d, desc, amt, bal, out=out:
+                               out.write(f"{d!s:10}  {desc:<16}${amt:>13,.2f}  ${bal:>14,.2f}\n"))
+
+        balance = opening
+        count = 0
+        for d, amt, exempt in rows:
+            balance += amt
+            count += 1
+            # interest and fees are the only transactions exempt from the limits
+            description = "interest/fee" if exempt else ""
+            for write in writers:
+                write(d, description, amt, balance)
+
+        for f, out in zip(formats, files):
+            if f == "csv":
+                csv.writer(out).writerow([end, "closing balance", "", balance])
+            else:
+                out.write(f"{end!s:10}  {'closing balance':<16}{'':>14}  ${balance:>14,.2f}\n")
+    finally:
+        rows.close()
+        for out in files:
+            out.close()
+    return StatementResult(number, opening, balance, count, paths)
+
+
+def _init_worker(path):
+    global _worker_sessions
+    _worker_sessions = sessionmaker(bind=make_engine(path))
+
+
+def _write_in_worker(args):
+    with _worker_sessions() as session:
+        return write_statements(session, *args)
+
+
+def export_statements(engine, start, end, out_dir, bank_id=None, formats=FORMATS, workers=1,
+                      batch_size=BATCH_SIZE):
+    """Writes statements for every account.
+
+    Args:
+        engine (Engine): engine of the bank database
+        start (Date): first day of the statements
+        end (Date): last day of the statements
+        out_dir (str): directory for the files; created if missing
+        bank_id (int, optional): only this bank's accounts. Defaults to None (every account).
+        formats (iterable, optional): "csv" and/or "txt". Defaults to both.
+        workers (int, optional): processes writing statements at once. Defaults to 1 (this process only).
+        batch_size (int, optional): rows fetched per round trip. Defaults to 1000.
+
+    Returns:
+        list: a StatementResult per account, in account number order
+    """
+    formats = tuple(formats)
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown statement format(s): {', '.join(sorted(unknown))}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    query = select(Account._id, Account._type, Account._account_number).order_by(Account._account_number)
+    if bank_id is not None:
+        query = query.where(Account._bank_id == bank_id)
+    with sessionmaker(bind=engine)() as session:
+        accounts = [tuple(row) for row in session.execute(query)]
+
+        workers = min(workers, len(accounts))
+        if workers <= 1:
+            return [write_statements(session, a, start, end, out_dir, formats, batch_size) for a in accounts]
+
+    if engine.url.database in (None, "", ":memory:"):
+        raise ValueError("Worker processes need a database file, not an in-memory database")
+    jobs = [(a, start, end, out_dir, formats, batch_size) for a in accounts]
+    # spawned, not forked: a fork would copy this process's pooled connections and any lock
+    # another thread (a commit coordinator, the logging listener) happened to hold
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(engine.url.database,)) as pool:
+        return list(pool.map(_write_in_worker, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write statements for every account.")
+    parser.add_argument("month", help="month to cover, as YYYY-MM")
+    parser.add_argument("--db", help="database file (default $BANK_DB or bank.db)")
+    parser.add_argument("--out", default="statements", help="output directory (default %(default)s)")
+    parser.add_argument("--format", choices=FORMATS, action="append",
+                        help="statement format; may be repeated (default both)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    start, end = month_range(datetime.strptime(args.month, "%Y-%m").date())
+    engine = make_engine(args.db)
+    began = time.perf_counter()
+    results = export_statements(engine, start, end, args.out, formats=args.format or FORMATS,
+                                workers=args.workers, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - began
+    print(f"Wrote statements for {len(results)} account(s), "
+          f"{sum(r.count for r in results)} transaction(s), to {args.out} in {elapsed:.2f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
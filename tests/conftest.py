@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import make_engine  # noqa: E402
+from migrations import upgrade  # noqa: E402
+
+
+@pytest.fixture
+def engine():
+    "An empty, upgraded in-memory bank database"
+    engine = make_engine(":memory:")
+    upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def sessions(engine):
+    return sessionmaker(bind=engine)
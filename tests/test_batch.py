@@ -0,0 +1,56 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+from BankCLI import BankCLI, UNEXPECTED_MESSAGE
+from database import Session
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BankCLI.py")
+
+
+def run_batch(tmp_path, script):
+    env = dict(os.environ, BANK_DB=str(tmp_path / "bank.db"))
+    result = subprocess.run([sys.executable, CLI, "--batch", "-"], input=script, capture_output=True,
+                            text=True, cwd=tmp_path, env=env, timeout=60)
+    return result.returncode, [json.loads(line) for line in result.stdout.splitlines()], result.stderr
+
+
+def test_bad_amount_fails_only_its_command(tmp_path):
+    status, results, stderr = run_batch(tmp_path, "open checking 100\nselect 1\nadd 5\nadd nan\nadd 7\n"
+                                                  "add inf\nadd 1e30\nsummary\n")
+    assert status == 1
+    assert [r["ok"] for r in results] == [True, True, True, False, True, False, False, True]
+    assert {results[i]["error"] for i in (3, 5, 6)} == {"CommandError"}
+    assert results[7]["accounts"] == [{"type": "checking", "account_number": 1, "balance": "112.00"}]
+    assert "Traceback" not in stderr
+
+
+def test_unexpected_error_fails_its_batch_as_json(engine, monkeypatch):
+    monkeypatch.setitem(Session.kw, "bind", engine)
+    cli = BankCLI()
+    try:
+        def broken():
+            raise RuntimeError("disk on fire")
+        cli._batch_commands["summary"] = broken
+        out = io.StringIO()
+        failed = cli.run_batch(["open checking 100", "summary", "commit", "open savings 20"], out=out)
+    finally:
+        cli._commits.stop()
+
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert failed == 2
+    assert [(r["line"], r["ok"]) for r in results] == [(1, False), (2, False), (3, True), (4, True)]
+    assert results[0]["error"] == results[1]["error"] == "RuntimeError"
+    assert results[0]["message"] == UNEXPECTED_MESSAGE
+    # only the second batch was saved
+    assert [a.type for a in cli._bank.summary(cli._session)] == ["savings"]
+
+
+def test_rejected_opening_deposit_leaves_nothing_behind(tmp_path):
+    status, results, stderr = run_batch(tmp_path, "open savings -5\nopen savings 5\nsummary\n")
+    assert status == 1
+    assert results[0]["error"] == "OverdrawError"
+    assert len(results[2]["accounts"]) == 1
+    assert "SAWarning" not in stderr
@@ -0,0 +1,77 @@
+import gc
+import weakref
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from Accounts import CheckingAccount
+from Bank import Bank, CHECKING
+from commits import CommitCoordinator
+
+
+@pytest.fixture
+def bank_id(sessions):
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        session.commit()
+        return bank._id
+
+
+def test_results_and_failures(sessions, bank_id):
+    commits = CommitCoordinator(sessions)
+    try:
+        number = commits.run(lambda session: session.get(Bank, bank_id).add_account(CHECKING, 10, session)
+                             ._account_number)
+        futures = [commits.submit(lambda session: session.get(Bank, bank_id).get_account(number)
+                                  .add_transaction(1, session)) for _ in range(5)]
+        failing = commits.submit(lambda session: session.get(Bank, bank_id).get_account(number)
+                                 .add_transaction(-1000, session))
+        for f in futures:
+            f.result()
+        assert type(failing.exception()).__name__ == "OverdrawError"
+    finally:
+        commits.stop()
+    with sessions() as session:
+        assert session.get(Bank, bank_id).get_account(number).get_balance() == 15
+
+
+def test_rolled_back_objects_are_not_kept(sessions, bank_id):
+    commits = CommitCoordinator(sessions)
+    refs = []
+
+    def job(session):
+        refs.append(weakref.ref(session.get(Bank, bank_id).add_account(CHECKING, 10, session)))
+        session.flush()
+        raise RuntimeError("rolled back")
+    try:
+        with pytest.raises(RuntimeError):
+            commits.run(job)
+        # a later group that loads nothing new
+        commits.run(lambda session: None)
+        gc.collect()
+        assert refs[0]() is None
+    finally:
+        commits.stop()
+
+
+def test_changes_that_cannot_be_stored_fail_only_their_job(sessions, bank_id):
+    with sessions() as session:
+        number = session.get(Bank, bank_id).add_account(CHECKING, 10, session)._account_number
+        session.commit()
+    # a window, so the three jobs share a group
+    commits = CommitCoordinator(sessions, window_ms=50)
+    try:
+        deposit = commits.submit(lambda session: session.get(Bank, bank_id).get_account(number)
+                                 .add_transaction(5, session))
+        # account numbers are unique, which only the INSERT finds out
+        duplicate = commits.submit(lambda session: session.add(CheckingAccount(number)))
+        another = commits.submit(lambda session: session.get(Bank, bank_id).get_account(number)
+                                 .add_transaction(7, session))
+        deposit.result()
+        another.result()
+        assert isinstance(duplicate.exception(), IntegrityError)
+    finally:
+        commits.stop()
+    with sessions() as session:
+        assert session.get(Bank, bank_id).get_account(number).get_balance() == 22
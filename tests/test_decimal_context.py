@@ -0,0 +1,68 @@
+import random
+from decimal import Decimal
+
+import pytest
+
+from Accounts import Account
+from Bank import Bank, SAVINGS, CHECKING
+from commits import CommitCoordinator
+from money import to_money
+
+
+def open_account(sessions, acct_type, amount):
+    with sessions() as session:
+        bank = session.query(Bank).first()
+        if bank is None:
+            bank = Bank()
+            session.add(bank)
+        number = bank.add_account(acct_type, amount, session)._account_number
+        session.commit()
+        return bank._id, number
+
+
+def booked_interest(sessions, number):
+    with sessions() as session:
+        account = session.query(Account).filter_by(_account_number=number).one()
+        return account._transactions[-1].amt
+
+
+def test_interest_is_the_same_on_every_thread(sessions):
+    # 1724141.55 * 0.029 = 50000.10495, which rounds differently if the product is first cut to 9 digits
+    bank_id, on_main = open_account(sessions, SAVINGS, Decimal("1724141.55"))
+    with sessions() as session:
+        session.get(Bank, bank_id).get_account(on_main).assess_interest_and_fees(session)
+        session.commit()
+
+    _, on_worker = open_account(sessions, SAVINGS, Decimal("1724141.55"))
+    commits = CommitCoordinator(sessions)
+    try:
+        commits.run(lambda session: session.get(Bank, bank_id).get_account(on_worker)
+                    .assess_interest_and_fees(session))
+    finally:
+        commits.stop()
+
+    assert booked_interest(sessions, on_main) == booked_interest(sessions, on_worker) == Decimal("50000.10")
+
+
+def test_large_balances_stay_exact(sessions):
+    bank_id, number = open_account(sessions, CHECKING, Decimal("20000000.05"))
+    with sessions() as session:
+        account = session.get(Bank, bank_id).get_account(number)
+        account.add_transaction(Decimal("0.01"), session)
+        assert account.get_balance() == Decimal("20000000.06")
+        session.commit()
+        assert account.verify_balance() == 0
+
+
+def test_ledger_interest_matches_decimal():
+    np = pytest.importorskip("numpy")
+    from analytics import interest_cents, to_dollars
+
+    rng = random.Random(0)
+    balances = [rng.choice([1, -1]) * rng.randint(0, 10 ** rng.randint(1, 12)) for _ in range(20000)]
+    rates = [rng.choice([29000, 1200, rng.randint(0, 10 ** 6)]) for _ in balances]
+    got = interest_cents(np.array(balances), np.array(rates))
+    for balance, rate, cents in zip(balances, rates, got):
+        assert to_dollars(cents) == to_money(Decimal(balance).scaleb(-2) * Decimal(rate).scaleb(-6))
+    with pytest.raises(OverflowError):
+        interest_cents(np.array([10 ** 13]), np.array([10 ** 6]))
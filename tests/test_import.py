@@ -0,0 +1,51 @@
+import io
+from datetime import date, timedelta
+from decimal import Decimal
+
+from Accounts import OverdrawError, TransactionSequenceError
+from Bank import Bank, CHECKING
+from money import InvalidAmountError
+
+
+def test_exempt_field_does_not_skip_the_rules(sessions):
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        number = bank.add_account(CHECKING, 10, session)._account_number
+        session.commit()
+
+        today = date.today()
+        source = io.StringIO(
+            "account,amount,date,exempt\n"
+            f"{number},-100000,{today},true\n"
+            f"{number},5,{today - timedelta(30)},true\n"
+            f"{number},5,{today},true\n")
+        rejected = bank.import_transactions(source, session, fmt="csv")
+        session.commit()
+
+        assert [(r.row, type(r.error)) for r in rejected] == [(2, OverdrawError), (3, TransactionSequenceError)]
+        account = bank.get_account(number)
+        assert account.get_balance() == Decimal("15.00")
+        assert not any(t.is_exempt() for t in account._transactions)
+
+
+def test_amounts_that_cannot_be_stored_are_rejected(sessions):
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        number = bank.add_account(CHECKING, 10, session)._account_number
+        session.commit()
+
+        source = io.StringIO(
+            f'{{"account": {number}, "amount": "nan"}}\n'
+            f'{{"account": {number}, "amount": "inf"}}\n'
+            f'{{"account": {number}, "amount": "1e30"}}\n'
+            f'{{"account": {number}, "amount": "92233720368547758.07"}}\n'
+            f'{{"account": {number}, "amount": "abc"}}\n'
+            f'{{"account": {number}, "amount": "5"}}\n')
+        rejected = bank.import_transactions(source, session, fmt="jsonl")
+        session.commit()
+
+        # row 4 fits in cents, but not once it is added to the balance
+        assert [(r.row, type(r.error)) for r in rejected] == [(row, InvalidAmountError) for row in range(1, 6)]
+        assert bank.get_account(number).get_balance() == Decimal("15.00")
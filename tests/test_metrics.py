@@ -0,0 +1,25 @@
+import pstats
+
+import metrics
+from Bank import Bank, CHECKING
+from commits import CommitCoordinator
+
+
+def test_profile_includes_the_coordinator_thread(sessions, tmp_path):
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        number = bank.add_account(CHECKING, 10, session)._account_number
+        session.commit()
+        bank_id = bank._id
+    commits = CommitCoordinator(sessions)
+    try:
+        assert metrics.start_profile(commits)
+        commits.run(lambda session: session.get(Bank, bank_id).get_account(number).add_transaction(5, session))
+        assert metrics.stop_profile(tmp_path / "bank.prof")
+    finally:
+        commits.stop()
+
+    profiled = {name for _, _, name in pstats.Stats(str(tmp_path / "bank.prof")).stats}
+    assert "add_transaction" in profiled
+    assert not metrics.is_profiling()
@@ -0,0 +1,92 @@
+import logging
+import sqlite3
+from decimal import Decimal
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from Accounts import Account
+from Bank import Bank, SAVINGS
+from database import make_engine
+import migrations
+from migrations import MigrationError, SCHEMA_VERSION, get_schema_version, upgrade
+
+# the schema and rows of a bank.db written before any migration existed (schema version 0)
+BASELINE_SCHEMA = """
+CREATE TABLE bank (_id INTEGER NOT NULL, PRIMARY KEY (_id));
+CREATE TABLE account (_id INTEGER NOT NULL, _bank_id INTEGER, _type VARCHAR, _account_number INTEGER,
+    PRIMARY KEY (_id), FOREIGN KEY(_bank_id) REFERENCES bank (_id));
+CREATE TABLE "transaction" (_id INTEGER NOT NULL, _amt FLOAT, _account_id INTEGER, _date DATE, _exempt BOOLEAN,
+    PRIMARY KEY (_id), FOREIGN KEY(_account_id) REFERENCES account (_id));
+CREATE TABLE savings_account (_id INTEGER NOT NULL, _daily_limit INTEGER, _monthly_limit INTEGER,
+    _interest_rate FLOAT, PRIMARY KEY (_id), FOREIGN KEY(_id) REFERENCES account (_id));
+CREATE TABLE checking_account (_id INTEGER NOT NULL, _balance_threshold FLOAT, _low_balance_fee FLOAT,
+    _interest_rate FLOAT, PRIMARY KEY (_id), FOREIGN KEY(_id) REFERENCES account (_id));
+INSERT INTO bank VALUES (1);
+INSERT INTO account VALUES (1, 1, 'savings', 1), (2, 1, 'checking', 2);
+INSERT INTO savings_account VALUES (1, 2, 5, 0.029);
+INSERT INTO checking_account VALUES (2, 100.0, -10.0, 0.0012);
+INSERT INTO "transaction" VALUES (1, 100.5, 1, '2026-10-17', 0), (2, 50.0, 2, '2026-10-17', 0),
+    (3, 3.333, 1, '2030-01-01', 0), (4, 3.011157, 1, '2030-01-31', 1),
+    (5, 0.06, 2, '2026-10-31', 1), (6, -10.0, 2, '2026-10-31', 1);
+"""
+
+
+def baseline_database(path, extra_sql=""):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA + extra_sql)
+    conn.close()
+    return make_engine(str(path))
+
+
+def test_upgrade_baseline_database(tmp_path):
+    engine = baseline_database(tmp_path / "bank.db")
+    assert upgrade(engine) == 0
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == SCHEMA_VERSION
+        # the running balances and the account number counter are filled in by the upgrade
+        assert conn.exec_driver_sql("SELECT _balance FROM account ORDER BY _id").scalars().all() == [10684, 4006]
+        assert conn.exec_driver_sql("SELECT _last_account_number FROM bank").scalar() == 2
+
+    with sessionmaker(bind=engine)() as session:
+        bank = session.get(Bank, 1)
+        assert bank.get_account(1).get_balance() == Decimal("106.84")
+        assert bank.get_account(2).get_balance() == Decimal("40.06")
+        assert bank.add_account(SAVINGS, 10, session)._account_number == 3
+        session.commit()
+        assert session.get(Account, 3).verify_balance() == 0
+
+    # a second upgrade has nothing to do
+    assert upgrade(engine) == SCHEMA_VERSION
+
+
+def test_upgrade_renumbers_duplicate_accounts(tmp_path, caplog):
+    # two processes once opened an account with the same number
+    engine = baseline_database(tmp_path / "bank.db", """
+        INSERT INTO account VALUES (3, 1, 'checking', 2);
+        INSERT INTO checking_account VALUES (3, 100.0, -10.0, 0.0012);
+        INSERT INTO "transaction" VALUES (7, 25.0, 3, '2026-10-17', 0);
+    """)
+    with caplog.at_level(logging.WARNING):
+        upgrade(engine)
+    assert "account 3 is now #000000003" in caplog.text
+
+    with sessionmaker(bind=engine)() as session:
+        bank = session.get(Bank, 1)
+        assert [a._account_number for a in bank.load_accounts(session)] == [1, 2, 3]
+        assert bank.get_account(3).get_balance() == Decimal("25.00")
+        assert bank.add_account(SAVINGS, 10, session)._account_number == 4
+
+
+def test_failed_step_leaves_the_version(tmp_path, monkeypatch):
+    engine = baseline_database(tmp_path / "bank.db")
+
+    def broken(conn):
+        raise ValueError("bad row")
+    steps = list(migrations.MIGRATIONS)
+    steps[1] = broken
+    monkeypatch.setattr(migrations, "MIGRATIONS", steps)
+    with pytest.raises(MigrationError, match="schema version 2 .*bad row.*left at version 1"):
+        upgrade(engine)
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == 1
@@ -0,0 +1,46 @@
+from decimal import Decimal, localcontext, BasicContext
+
+import pytest
+
+from Bank import Bank, CHECKING
+from Transactions import Transaction
+from money import InvalidAmountError, Money, to_money
+
+
+@pytest.mark.parametrize("amount", ["10000000", "20000000.05", "1000000045.00", "-92233720368547758.07"])
+def test_large_amounts_round_trip_in_a_low_precision_context(amount):
+    money = Money()
+    with localcontext(BasicContext):
+        stored = money.process_bind_param(Decimal(amount), None)
+        assert money.process_result_value(stored, None) == Decimal(amount)
+        assert to_money(Decimal(amount + "4" if "." in amount else amount + ".004")) == Decimal(amount)
+        assert Transaction(Decimal(amount), 1).amt == Decimal(amount)
+
+
+def test_large_balance_is_saved(sessions):
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        number = bank.add_account(CHECKING, 11000000, session)._account_number
+        session.commit()
+    with sessions() as session:
+        assert session.query(Bank).one().get_account(number).get_balance() == Decimal("11000000.00")
+
+
+@pytest.mark.parametrize("amount", ["nan", "-inf", "1e30", "92233720368547758.08", "abc"])
+def test_invalid_amounts_are_rejected(amount):
+    with pytest.raises(InvalidAmountError):
+        Transaction(amount, 1)
+
+
+def test_balance_too_large_to_store_is_rejected(sessions):
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        account = bank.add_account(CHECKING, Decimal("92233720368547758.07"), session)
+        session.commit()
+        with pytest.raises(InvalidAmountError):
+            account.add_transaction(Decimal("0.01"), session)
+        # nothing was added, so the account can still be saved
+        session.commit()
+        assert account.get_balance() == Decimal("92233720368547758.07")
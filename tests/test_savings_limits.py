@@ -0,0 +1,64 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from Accounts import OverdrawError, TransactionLimitError, TransactionSequenceError
+from Bank import Bank, SAVINGS
+from Transactions import Transaction
+
+
+def over_limit(account, transactions, t1):
+    "The limit check as it was before the counters: two scans of the whole history"
+    num_today = len([t2 for t2 in transactions if not t2.is_exempt() and t2.in_same_day(t1)])
+    num_this_month = len([t2 for t2 in transactions if not t2.is_exempt() and t2.in_same_month(t1)])
+    return num_today >= account._daily_limit or num_this_month >= account._monthly_limit
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_limit_decisions_match_full_scan(sessions, seed):
+    rng = random.Random(seed)
+    session = sessions()
+    bank = Bank()
+    session.add(bank)
+    number = bank.add_account(SAVINGS, 1000, session)._account_number
+    session.commit()
+    bank_id = bank._id
+    # the opening deposit is dated today
+    day = date.today()
+    checked = 0
+
+    for step in range(400):
+        account = session.get(Bank, bank_id).get_account(number)
+        if rng.random() < 0.1:
+            # a month-end run saves a snapshot, so later counters start from it
+            try:
+                account.assess_interest_and_fees(session)
+            except TransactionSequenceError:
+                # nothing new since the month was assessed
+                pass
+            day = Transaction(0, number, date=day).last_day_of_month() + timedelta(1)
+        else:
+            day += timedelta(rng.choice([0, 0, 0, 1, 1, 3, 12]))
+            # now and then a back-dated one, which the limits see before the date check
+            when = day - timedelta(rng.randint(1, 20)) if rng.random() < 0.05 else day
+            exempt = rng.random() < 0.1
+            history = session.scalars(select(Transaction).where(Transaction._account_id == account._id)).all()
+            expected = not exempt and over_limit(account, history, Transaction(1, number, date=when))
+            try:
+                account.add_transaction(rng.randint(1, 50), session, when, exempt)
+                limited = False
+            except TransactionLimitError:
+                limited = True
+            except (OverdrawError, TransactionSequenceError):
+                limited = False
+            assert limited == expected, f"step {step}: {when}"
+            checked += 1
+        if rng.random() < 0.15:
+            # reload, so the counters are rebuilt from the database
+            session.commit()
+            session.close()
+            session = sessions()
+    session.close()
+    assert checked > 300
@@ -0,0 +1,59 @@
+import asyncio
+from datetime import date, timedelta
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+from Accounts import OverdrawError, TransactionSequenceError  # noqa: E402
+from database import make_engine, make_async_engine  # noqa: E402
+from migrations import upgrade  # noqa: E402
+from money import InvalidAmountError  # noqa: E402
+from service import BadRequest, BankService  # noqa: E402
+
+
+def test_transactions_cannot_be_exempt(tmp_path):
+    path = str(tmp_path / "bank.db")
+    upgrade(make_engine(path))
+
+    async def scenario():
+        engine = make_async_engine(path)
+        try:
+            service = await BankService.open(engine)
+            _, opened = await service.handle("POST", "/accounts", {}, {"type": "checking", "amount": "10"})
+            url = f"/accounts/{opened['account_number']}/transactions"
+            for body in [{"amount": "-100000", "exempt": True}, {"amount": "5", "exempt": "false"}]:
+                with pytest.raises(BadRequest):
+                    await service.handle("POST", url, {}, body)
+            with pytest.raises(OverdrawError):
+                await service.handle("POST", url, {}, {"amount": "-100000"})
+            with pytest.raises(TransactionSequenceError):
+                await service.handle("POST", url, {}, {"amount": "5", "date": str(date.today() - timedelta(30))})
+            _, account = await service.handle("GET", f"/accounts/{opened['account_number']}", {}, {})
+            assert account["balance"] == "10.00"
+        finally:
+            await engine.dispose()
+    asyncio.run(scenario())
+
+
+def test_invalid_amounts_are_bad_requests(tmp_path):
+    path = str(tmp_path / "bank.db")
+    upgrade(make_engine(path))
+
+    async def scenario():
+        engine = make_async_engine(path)
+        try:
+            service = await BankService.open(engine)
+            for amount in ["nan", "Infinity", "1e30"]:
+                with pytest.raises(InvalidAmountError):
+                    await service.handle("POST", "/accounts", {}, {"type": "checking", "amount": amount})
+            _, opened = await service.handle("POST", "/accounts", {}, {"type": "checking",
+                                                                       "amount": "92233720368547758.07"})
+            with pytest.raises(InvalidAmountError):
+                await service.handle("POST", f"/accounts/{opened['account_number']}/transactions", {},
+                                     {"amount": "1"})
+            _, account = await service.handle("GET", f"/accounts/{opened['account_number']}", {}, {})
+            assert account["balance"] == "92233720368547758.07"
+        finally:
+            await engine.dispose()
+    asyncio.run(scenario())
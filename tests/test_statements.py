@@ -0,0 +1,38 @@
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy.orm import sessionmaker
+
+from Bank import Bank, CHECKING, SAVINGS
+from commits import CommitCoordinator
+from database import make_engine
+from migrations import upgrade
+from statements import export_statements, month_range
+
+
+def test_workers_export_while_the_coordinator_runs(tmp_path):
+    engine = make_engine(str(tmp_path / "bank.db"))
+    upgrade(engine)
+    sessions = sessionmaker(bind=engine)
+    with sessions() as session:
+        bank = Bank()
+        session.add(bank)
+        for acct_type, amount in [(SAVINGS, 100), (CHECKING, 250)]:
+            bank.add_account(acct_type, amount, session)
+        session.commit()
+        bank_id = bank._id
+
+    commits = CommitCoordinator(sessions)
+    try:
+        commits.run(lambda session: session.get(Bank, bank_id).get_account(1).add_transaction(5, session))
+        start, end = month_range(date.today())
+        results = export_statements(make_engine(str(tmp_path / "bank.db")), start, end, str(tmp_path / "out"),
+                                    bank_id, workers=2)
+        # the caller's engine and the coordinator keep working
+        commits.run(lambda session: session.get(Bank, bank_id).get_account(2).add_transaction(5, session))
+    finally:
+        commits.stop()
+    engine.dispose()
+
+    assert [(r.account_number, r.closing) for r in results] == [(1, Decimal("105.00")), (2, Decimal("250.00"))]
+    assert all(len(r.paths) == 2 for r in results)
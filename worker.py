@@ -0,0 +1,80 @@
+import queue
+
+from commits import make_coordinator
+
+
+class DatabaseWorker():
+    """Runs database work off the Tk mainloop so it never waits on SQLite.
+
+    Jobs go to a CommitCoordinator, which runs them in the order they were submitted
+    on its own thread and session and commits them in groups. Their results and
+    exceptions are handed back to callbacks on the mainloop with after(), once the
+    work is saved."""
+
+    def __init__(self, window, session_factory, poll_ms=16, on_busy=None, commits=None):
+        """
+        Args:
+            window (Tk): window whose mainloop receives the results
+            session_factory (callable): creates the coordinator's session, e.g. a sessionmaker
+            poll_ms (int, optional): how often the mainloop checks for results. Defaults to 16 (about 60 fps).
+            on_busy (callable, optional): called on the mainloop with True when work starts and False when the queue empties.
+            commits (CommitCoordinator, optional): coordinator to use. Defaults to one configured by make_coordinator.
+        """
+        self._window = window
+        self._poll_ms = poll_ms
+        self._on_busy = on_busy
+        self._results = queue.Queue()
+        self._pending = 0
+        self._commits = commits or make_coordinator(session_factory)
+        self._window.after(self._poll_ms, self._poll)
+
+    @property
+    def busy(self):
+        "True while submitted jobs have not reported back yet"
+        return self._pending > 0
+
+    def submit(self, job, on_success=None, on_error=None):
+        """Queues a job for the coordinator.
+
+        Args:
+            job (callable): takes the coordinator's session and does the work, without committing.
+                It may be run again if its group conflicts with another writer, and must not
+                return ORM objects, since they belong to the coordinator's session.
+            on_success (callable, optional): called on the mainloop with the job's return value once it is committed
+            on_error (callable, optional): called on the mainloop with the exception if the job or its commit failed.
+                Without it the exception is re-raised on the mainloop.
+        """
+        self._pending += 1
+        if self._pending == 1 and self._on_busy:
+            self._on_busy(True)
+
+        # runs on the coordinator thread; the mainloop picks the outcome up in _poll
+        def report(future):
+            error = future.exception()
+            if error is None:
+                self._results.put((on_success, future.result(), False))
+            else:
+                self._results.put((on_error, error, True))
+        self._commits.submit(job).add_done_callback(report)
+
+    def stop(self):
+        """Commits the queued jobs and ends the coordinator thread"""
+        self._commits.stop()
+
+    def _poll(self):
+        try:
+            while True:
+                callback, value, failed = self._results.get_nowait()
+                try:
+                    if callback:
+                        callback(value)
+                    elif failed:
+                        raise value
+                finally:
+                    self._pending -= 1
+                    if self._pending == 0 and self._on_busy:
+                        self._on_busy(False)
+        except queue.Empty:
+            pass
+        finally:
+            self._window.after(self._poll_ms, self._poll)